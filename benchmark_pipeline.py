@@ -0,0 +1,153 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import Instrumentation, peak_rss_mb, reset_peak_rss
+
+"""Benchmark of the pipeline stages on synthetic data from `synthetic_tma.py`.
+
+Every stage runs in a fresh process on the outputs of the previous stage, with its peak memory reset before the
+stage (Linux), so the measured peak memory belongs to that stage and its workers, on top of the loaded libraries.
+Results are written as JSON named after the current commit, compare two runs with `--compare`. With `--log`, the
+stages also write their detailed records (per plate, gate, patient, spot, cluster) to a run log.
+"""
+
+SCALES = [10000, 1000000, 10000000]
+STAGES = ['ingest', 'qc', 'roi_correction', 'neighbor_index', 'gmm', 'neighborhood']
+
+
+def run_ingest(data_dir, store, n_jobs=1, instrument=None, **kwargs):
+    from histocat_data_processing import ingest_histocat
+    return ingest_histocat(os.path.join(data_dir, 'histocat_output'), os.path.join(store, 'cells'), n_jobs=n_jobs,
+                           instrument=instrument)
+
+
+def run_qc(data_dir, store, n_jobs=1, instrument=None, **kwargs):
+    from intensity_mask_size_qc import lost_cell_qc
+    from cell_store import get_plate_codes, read_annotation
+    lost_cell_qc(store, list(get_plate_codes(store)), n_jobs=n_jobs, instrument=instrument)
+    return len(read_annotation(store, 'labeled_as_lost'))
+
+
+def run_roi_correction(data_dir, store, instrument=None, **kwargs):
+    from correct_ROI_ids import read_ashlar_mapping, correct_store_rois
+    return len(correct_store_rois(store, read_ashlar_mapping(os.path.join(data_dir, 'tma_ROI ashlar mapping.csv')),
+                                  instrument))
+
+
+def run_neighbor_index(data_dir, store, **kwargs):
+    from neighbor_index import build_store_index
+    return build_store_index(store, os.path.join(store, 'neighbor_index.npz')).spot_ptr[-1]
+
+
+def run_gmm(data_dir, store, n_jobs=1, instrument=None, **kwargs):
+    from gmm_gating import gate_store
+    from synthetic_tma import CHANNEL_NAMES
+    # synthetic data has no patient sheet, every ROI is gated separately
+    return len(gate_store(store, CHANNEL_NAMES, n_jobs=n_jobs, instrument=instrument))
+
+
+def run_neighborhood(data_dir, store, n_jobs=1, num_permutations=100, instrument=None, **kwargs):
+    from neighborhood_analysis_of_clusters import analyze_store
+    from cell_store import read_annotation
+    analyze_store(store, os.path.join(store, 'neighbor_index.npz'), data_dir, n_jobs=n_jobs, random_state=0,
+                  instrument=instrument, num_permutations=num_permutations)
+    return read_annotation(store, 'cluster').notnull().sum()
+
+
+def _run_stage(stage, data_dir, store, kwargs):
+    # the peak of the fresh process so far is the interpreter and the imports, not the stage
+    reset_peak_rss()
+    start = time.perf_counter()
+    rows = globals()['run_' + stage](data_dir, store, **kwargs)
+    return {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb(), 'rows': int(rows)}
+
+
+def benchmark_scale(n_cells, work_dir, stages=STAGES, n_plates=4, n_jobs=1, num_permutations=100, log_fn=None):
+    """Benchmark the stages on a synthetic data set of `n_cells` cells, generated once in work_dir and reused.
+
+    Returns
+    ========
+    results : list
+        one dict per stage with the scale, stage, seconds, peak_rss_mb and rows, or the error of a failed stage.
+        Stages after a failed stage are still run, they may fail on missing inputs.
+    """
+    from synthetic_tma import write_synthetic_tma
+    data_dir = os.path.join(work_dir, 'cells_{}'.format(n_cells))
+    store = os.path.join(data_dir, 'cell_store')
+    if not os.path.exists(os.path.join(data_dir, 'tma_ROI ashlar mapping.csv')):
+        write_synthetic_tma(data_dir, n_cells, n_plates)
+    kwargs = {'n_jobs': n_jobs, 'num_permutations': num_permutations,
+              'instrument': Instrumentation(log_fn, n_cells=n_cells)}
+    results = []
+    for stage in stages:
+        result = {'n_cells': n_cells, 'stage': stage}
+        # a fresh process per stage, so the peak memory of earlier stages is not carried over
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                result.update(executor.submit(_run_stage, stage, data_dir, store, kwargs).result())
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, str(e).split('\n')[0])
+        print(result)
+        results.append(result)
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare_benchmarks(baseline_fn, new_fn):
+    """Table of the stage timings and peak memory of two benchmark files, with new over baseline ratios.
+    """
+    tables = []
+    for fn in [baseline_fn, new_fn]:
+        with open(fn) as f:
+            results = pd.DataFrame(json.load(f)['results']).set_index(['n_cells', 'stage'])
+        tables.append(results.reindex(columns=['seconds', 'peak_rss_mb']))
+    comparison = tables[0].join(tables[1], lsuffix='_baseline', rsuffix='_new', how='outer')
+    for col in ['seconds', 'peak_rss_mb']:
+        comparison[col + '_ratio'] = comparison[col + '_new'] / comparison[col + '_baseline']
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--work-dir', default='benchmark_data')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--plates', type=int, default=4)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--permutations', type=int, default=100)
+    parser.add_argument('--out', default=None, help='defaults to benchmark_<commit>.json in the work dir')
+    parser.add_argument('--log', default=None, help='JSONL run log of the stage details')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+    if args.compare:
+        pd.set_option('display.width', 200)
+        print(compare_benchmarks(*args.compare).round(2))
+        sys.exit()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    commit = get_commit()
+    results = []
+    for n_cells in args.scales:
+        results += benchmark_scale(n_cells, args.work_dir, args.stages, args.plates, args.n_jobs, args.permutations,
+                                   args.log)
+    out = args.out or os.path.join(args.work_dir, 'benchmark_{}.json'.format(commit))
+    with open(out, 'w') as f:
+        json.dump({'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'pandas': pd.__version__, 'cpu_count': os.cpu_count(),
+                   'n_jobs': args.n_jobs, 'results': results}, f, indent=1)
+    print('Results written to', out)
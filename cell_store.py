@@ -0,0 +1,185 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import tempfile
+
+"""Single on-disk cell store shared by all pipeline stages.
+
+Layout of a store folder:
+    cells/Plate=<plate>/ROI=<roi>/part-0.parquet
+        one partition per ROI as written by `histocat_data_processing.ingest_histocat`, with the expression,
+        measurements and neighbour columns of every cell.
+    annotations/<name>.parquet
+        columns added by later stages (e.g. the boolean `labeled_as_lost`, the ashlar corrected `ROI`, `cluster`),
+        keyed by `cell_key`. Annotations take precedence over ingested columns of the same name.
+    plates.json
+        append-only list of plates, the position of a plate is its code in the cell keys.
+
+Cells are identified by an int64 `cell_key` built from the plate code, the histoCAT ROI and the CellId, replacing
+string ids such as `TMA1_12_345`.
+"""
+
+CELLS_DIR = 'cells'
+ANNOTATION_DIR = 'annotations'
+ROI_SHIFT = 24
+PLATE_SHIFT = 44
+
+
+def make_cell_keys(plate_codes, rois, cell_ids):
+    return (np.asarray(plate_codes, dtype=np.int64) << PLATE_SHIFT) | \
+        (np.asarray(rois, dtype=np.int64) << ROI_SHIFT) | np.asarray(cell_ids, dtype=np.int64)
+
+
+def _cells_dataset(store):
+    """Parquet dataset of the ingested cells. The schema is unified over all ROI files, as the number of neighbour
+    columns varies per ROI and would otherwise be taken from the first file only.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    path = os.path.join(store, CELLS_DIR)
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning)
+    schema = pa.unify_schemas([x.physical_schema for x in dataset.get_fragments()], promote_options='permissive')
+    for field in dataset.schema:
+        if field.name not in schema.names:
+            schema = schema.append(field)
+    return ds.dataset(path, format='parquet', partitioning=partitioning, schema=schema)
+
+
+def get_plate_codes(store):
+    """Plate name to code mapping. Plates found in the store but not registered yet are appended. The registry is
+    replaced atomically, as stages running in parallel on a fresh store may register the same plates concurrently.
+    """
+    fn = os.path.join(store, 'plates.json')
+    plates = []
+    if os.path.exists(fn):
+        with open(fn) as f:
+            plates = json.load(f)
+    found = sorted(x.split('=', 1)[1] for x in os.listdir(os.path.join(store, CELLS_DIR)) if x.startswith('Plate='))
+    new_plates = [x for x in found if x not in plates]
+    if new_plates:
+        plates += new_plates
+        fd, tmp_fn = tempfile.mkstemp(suffix='.tmp', prefix='plates.', dir=store)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(plates, f)
+        os.replace(tmp_fn, fn)
+    return {plate: i for i, plate in enumerate(plates)}
+
+
+def list_columns(store):
+    """All columns available in the store, ingested and annotations.
+    """
+    columns = _cells_dataset(store).schema.names
+    annotation_dir = os.path.join(store, ANNOTATION_DIR)
+    if os.path.exists(annotation_dir):
+        columns += [x[:-len('.parquet')] for x in sorted(os.listdir(annotation_dir)) if x.endswith('.parquet')]
+    return list(dict.fromkeys(columns))
+
+
+def write_annotation(store, name, values):
+    """Store a column computed by a pipeline stage.
+
+    Parameters
+    ========
+    store : str
+        store folder.
+    name : str
+        column name.
+    values : pd.Series
+        values indexed by cell key. Cells not included are missing (NaN) when loaded.
+    """
+    annotation_dir = os.path.join(store, ANNOTATION_DIR)
+    os.makedirs(annotation_dir, exist_ok=True)
+    values = pd.DataFrame({'cell_key': np.asarray(values.index, dtype=np.int64), name: values.values})
+    fn = os.path.join(annotation_dir, name + '.parquet')
+    values.to_parquet(fn + '.tmp', index=False)
+    os.replace(fn + '.tmp', fn)
+
+
+def read_annotation(store, name):
+    values = pd.read_parquet(os.path.join(store, ANNOTATION_DIR, name + '.parquet'))
+    return values.set_index('cell_key')[name]
+
+
+def _filter_expression(filters):
+    import pyarrow.dataset as ds
+    expression = None
+    for col, op, value in filters:
+        field = ds.field(col)
+        _expression = {'==': lambda: field == value, '!=': lambda: field != value, '<': lambda: field < value,
+                       '<=': lambda: field <= value, '>': lambda: field > value, '>=': lambda: field >= value,
+                       'in': lambda: field.isin(value)}[op]()
+        expression = _expression if expression is None else expression & _expression
+    return expression
+
+
+def _filter_mask(series, op, value):
+    return {'==': lambda: series == value, '!=': lambda: series != value, '<': lambda: series < value,
+            '<=': lambda: series <= value, '>': lambda: series > value, '>=': lambda: series >= value,
+            'in': lambda: series.isin(value)}[op]().values
+
+
+def load_cells(store, columns=None, filters=None, annotations=True):
+    """Load the cells of the store with column projection and predicate pushdown.
+
+    Parameters
+    ========
+    store : str
+        store folder.
+    columns : list or None
+        columns to load, ingested or annotations. None loads all ingested columns. `Plate`, `ROI` and `CellId` are
+        always included.
+    filters : list or None
+        (column, op, value) tuples combined with AND, op being one of '==', '!=', '<', '<=', '>', '>=' and 'in', e.g.
+        [('Plate', '==', 'TMA1'), ('labeled_as_lost', '==', False)]. Filters on ingested columns are pushed down to
+        the Parquet reader, so only matching partitions and row groups are read.
+    annotations : bool
+        if False, only ingested columns are used, e.g. to get the histoCAT ROI even after the ROI correction.
+
+    Returns
+    ========
+    cells : pd.DataFrame
+        requested cells indexed by `cell_key`.
+    """
+    dataset = _cells_dataset(store)
+    annotation_dir = os.path.join(store, ANNOTATION_DIR)
+    annotation_names = [] if (not annotations) | (not os.path.exists(annotation_dir)) else [
+        x[:-len('.parquet')] for x in os.listdir(annotation_dir) if x.endswith('.parquet')]
+    filters = [] if filters is None else filters
+    if columns is None:
+        columns = dataset.schema.names
+    key_cols = ['Plate', 'ROI', 'CellId']
+    requested = list(dict.fromkeys(key_cols + list(columns)))
+    annotation_cols = [x for x in requested if x in annotation_names]
+    base_cols = [x for x in requested if x not in annotation_cols]
+    base_cols += [x for x in key_cols if x not in base_cols]
+    base_filters = [x for x in filters if x[0] not in annotation_names]
+    annotation_filters = [x for x in filters if x[0] in annotation_names]
+
+    # ingested columns, the histoCAT ROI is needed for the keys even if an annotation replaces it
+    table = dataset.to_table(columns=base_cols, filter=_filter_expression(base_filters) if base_filters else None)
+    cells = table.to_pandas()
+    plate_codes = cells.Plate.astype(str).map(get_plate_codes(store)).values
+    cells.index = pd.Index(make_cell_keys(plate_codes, cells.ROI.astype(int).values, cells.CellId.values),
+                           name='cell_key')
+    keep = np.ones(len(cells), dtype=bool)
+    for col, op, value in annotation_filters:
+        keep &= _filter_mask(read_annotation(store, col).reindex(cells.index), op, value)
+    cells = cells[keep]
+    for col in annotation_cols:
+        cells[col] = read_annotation(store, col).reindex(cells.index).values
+    return cells[requested]
+
+
+def load_roi(store, tma_roi, columns=None):
+    """Load a single ROI given as `<plate>_<roi>`, with the ROI as currently annotated (ashlar corrected if available).
+    """
+    plate, roi = tma_roi.rsplit('_', 1)
+    return load_cells(store, columns, filters=[('Plate', '==', plate), ('ROI', '==', int(roi))])
+
+
+def cell_ids(cells):
+    """String cell ids `<plate>_<roi>_<cellid>` of the original layout.
+    """
+    return cells.Plate.astype(str) + '_' + cells.ROI.astype(str) + '_' + cells.CellId.astype(str)
@@ -1,30 +1,102 @@
 # Correct ROI IDs
 
 import pandas as pd
+import numpy as np
 import os
+from cell_store import load_cells, list_columns, write_annotation, cell_ids
+from instrumentation import Instrumentation
 
-path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/histocat_output'
-os.chdir(path)
-ashlar_meta = pd.read_excel(
-    '../processed_data/tma_ROI ashlar mapping.xlsx', sheet_name=0, skiprows=2, index_col=0)
-metadata = pd.read_csv('../processed_data/tma_metadata.csv', index_col=0)
-new_metadata = pd.DataFrame()
-expr = pd.DataFrame()
-for i in range(1, 5):
-    print('processing plate {}'.format(str(i)))
-    fn = 'TMA0_nuclei_log_normed.csv'.replace('0', str(i))
-    _expr = pd.read_csv('../processed_data/' + fn, index_col=0)
-    _expr_meta = metadata.loc[_expr.index]
-    _expr_meta['real_ROI'] = ashlar_meta.reset_index().set_index(
-        'TMA{}'.format(str(i))).loc[_expr_meta.ROI.values, 'Ashlar_ROI'].values
-    new_indx = _expr_meta.apply(lambda x: '_'.join(
-        [x.name.split('_')[0], str(x.real_ROI), x.name.split('_')[2]]), axis=1).values
-    _expr_meta.index = new_indx
-    _expr.index = new_indx
-    expr = expr.append(_expr)
-    new_metadata = new_metadata.append(_expr_meta)
-expr.to_hdf('../processed_data/index_corrected_tma_expr_data.hdf',
-            key='corrected')
-new_metadata.ROI = new_metadata.real_ROI
-new_metadata.drop('real_ROI', axis=1, inplace=True)
-new_metadata.to_csv('../processed_data/index_corrected_tma_metadata.csv')
+
+def read_ashlar_mapping(fn):
+    """Read the ashlar mapping sheet, the excel file as provided or a CSV with the same columns.
+    """
+    if fn.endswith('.csv'):
+        return pd.read_csv(fn, index_col=0)
+    return pd.read_excel(fn, sheet_name=0, skiprows=2, index_col=0)
+
+
+def get_roi_mapping(ashlar_meta, plates):
+    """Long (Plate, ROI, Ashlar_ROI) table from the ashlar mapping sheet, which has one column of histoCAT ROIs per
+    plate and the matching `Ashlar_ROI`. Raises ValueError if a histoCAT ROI or an ashlar ROI is used twice on a plate.
+    Plates without a column in the sheet have no mapped ROIs.
+    """
+    mapping = ashlar_meta.reset_index().melt(
+        id_vars='Ashlar_ROI', value_vars=[x for x in plates if x in ashlar_meta.columns], var_name='Plate',
+        value_name='ROI').dropna()
+    mapping = mapping.astype({'ROI': np.int64, 'Ashlar_ROI': np.int64})
+    for cols in [['Plate', 'ROI'], ['Plate', 'Ashlar_ROI']]:
+        duplicated = mapping.duplicated(cols, keep=False)
+        if duplicated.any():
+            raise ValueError('Duplicate ROIs in the ashlar mapping:\n{}'.format(
+                mapping[duplicated].sort_values(cols).to_string(index=False)))
+    return mapping
+
+
+def correct_roi_ids(metadata, ashlar_meta, plate_col='Plate', roi_col='ROI'):
+    """Map the histoCAT ROI of every cell to its ashlar ROI.
+
+    The mapping is resolved once per unique (plate, ROI) pair and broadcast to the cells through integer group
+    codes, so there is no per-cell Python.
+
+    Parameters
+    ========
+    metadata : pd.DataFrame
+        table with the plate and histoCAT ROI of every cell.
+    ashlar_meta : pd.DataFrame
+        ashlar mapping sheet, see `get_roi_mapping`.
+    (plate, roi)_col : str
+        column names of the plate and ROI in the metadata table.
+
+    Returns
+    ========
+    real_roi : pd.Series
+        ashlar ROI of every cell, indexed like metadata. A ValueError lists all (plate, ROI) pairs without a mapping
+        and duplicated mappings before anything is changed.
+    """
+    group_codes = metadata.groupby([plate_col, roi_col], observed=True, sort=False).ngroup().values
+    rois = metadata[[plate_col, roi_col]].iloc[np.unique(group_codes, return_index=True)[1]]
+    rois = pd.DataFrame({'Plate': rois[plate_col].astype(str).values,
+                         'ROI': rois[roi_col].astype(np.int64).values})
+    mapping = get_roi_mapping(ashlar_meta, rois.Plate.unique())
+    rois = rois.merge(mapping, on=['Plate', 'ROI'], how='left')
+    unmapped = rois.Ashlar_ROI.isnull()
+    if unmapped.any():
+        raise ValueError('ROIs without ashlar mapping:\n{}'.format(
+            rois.loc[unmapped, ['Plate', 'ROI']].to_string(index=False)))
+    return pd.Series(rois.Ashlar_ROI.values.astype(np.int64)[group_codes], index=metadata.index, name=roi_col)
+
+
+def correct_store_rois(store, ashlar_meta, instrument=None):
+    """Correct the ROIs of all cells of the cell store and save them as the `ROI` annotation. Expression and
+    metadata share the cell keys, so one annotation corrects both.
+    """
+    instrument = Instrumentation() if instrument is None else instrument
+    with instrument.span('stage', stage='correct_roi_ids') as stage_record:
+        # the histoCAT ROIs, ignoring a previous correction
+        metadata = load_cells(store, ['Plate', 'ROI'], annotations=False)
+        real_roi = correct_roi_ids(metadata, ashlar_meta)
+        write_annotation(store, 'ROI', real_roi)
+        stage_record['rows'] = len(real_roi)
+    return real_roi
+
+
+def export_corrected_tables(store, out_dir):
+    """Write the ROI corrected expression (HDF) and metadata (CSV) tables with string ids for the notebooks.
+    """
+    cells = load_cells(store, list_columns(store))
+    cells.index = cell_ids(cells).values
+    if 'labeled_as_lost' in cells.columns:
+        cells.labeled_as_lost = cells.labeled_as_lost.map({True: 'Yes', False: 'No'})
+    cells.loc[:, 'Cell_Marker1':'Cell_Marker44'].to_hdf(
+        os.path.join(out_dir, 'index_corrected_tma_expr_data.hdf'), key='corrected')
+    cells.drop(['CellId'] + ['Cell_Marker{}'.format(i) for i in range(1, 45)], axis=1).to_csv(
+        os.path.join(out_dir, 'index_corrected_tma_metadata.csv'))
+
+
+if __name__ == '__main__':
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/histocat_output'
+    os.chdir(path)
+    ashlar_meta = read_ashlar_mapping('../processed_data/tma_ROI ashlar mapping.xlsx')
+    store = '../processed_data/cell_store'
+    correct_store_rois(store, ashlar_meta, Instrumentation('../results/run_log.jsonl'))
+    export_corrected_tables(store, '../processed_data')
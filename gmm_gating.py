@@ -1,14 +1,50 @@
 import pandas as pd
 import os
+import re
 import numpy as np
-from sklearn import mixture
 from hdbscan import HDBSCAN
 from sklearn.cluster import KMeans
 from cycifsuite.get_data import read_synapse_file
-from sklearn.mixture import GaussianMixture
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from cell_store import load_cells, write_annotation, cell_ids
+from instrumentation import Instrumentation
 
+# Gating hierarchy, Ecad=>SMA=>CD45 with additional gating on Ki67 and gH2ax. Gates run in the listed order and
+# a gate with a `parent` only gates the cells labeled `parent_label` by that parent gate. The order also sets the
+# column order of the output, which the final cluster names are built from.
+GATING_TREE = [
+    {'name': 'Ecad', 'markers': ['Ecad', 'CK8-FITC']},
+    {'name': 'Round_2a', 'markers': ['aSMA'], 'parent': 'Ecad', 'parent_label': 'Ecad_low'},
+    {'name': 'Round_2b', 'markers': ['gH2ax-PE'], 'parent': 'Ecad', 'parent_label': 'Ecad_high'},
+    {'name': 'Round_3', 'markers': ['CD45-PE'], 'parent': 'Round_2a', 'parent_label': 'aSMA_low'},
+    {'name': 'CD4', 'markers': ['CD4'], 'parent': 'Round_3', 'parent_label': 'CD45-PE_high'},
+    {'name': 'CD8', 'markers': ['CD8a'], 'parent': 'Round_3', 'parent_label': 'CD45-PE_high'},
+    {'name': 'Ki67', 'markers': ['Ki67-570']},
+]
 
-def iterative_gmm(expr_data, col, cluster_info=None, n_comp=2, iteration='Round_1'):
+# final cluster names of the combinations of the GATING_TREE labels, joined by '|' in gate order. Only valid for
+# GATING_TREE, other trees need their own mapping.
+CLUSTER_NAMES = {
+    'Ecad_high||gH2ax-PE_high||||Ki67-570_high': 'Epi|gH2_high|Ki67_high',
+    'Ecad_high||gH2ax-PE_high||||Ki67-570_low': 'Epi|gH2_high|Ki67_low',
+    'Ecad_high||gH2ax-PE_low||||Ki67-570_high': 'Epi|gH2_low|Ki67_high',
+    'Ecad_high||gH2ax-PE_low||||Ki67-570_low': 'Epi|gH2_low|Ki67_low',
+    'Ecad_low|aSMA_high|||||Ki67-570_high': 'Stromal|Ki67_high',
+    'Ecad_low|aSMA_high|||||Ki67-570_low': 'Stromal|Ki67_low',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_high|CD8a_high|Ki67-570_high': 'CD45_DP',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_high|CD8a_high|Ki67-570_low': 'CD45_DP',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_high|CD8a_low|Ki67-570_high': 'CD45_CD4',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_high|CD8a_low|Ki67-570_low': 'CD45_CD4',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_low|CD8a_high|Ki67-570_high': 'CD45_CD8',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_low|CD8a_high|Ki67-570_low': 'CD45_CD8',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_low|CD8a_low|Ki67-570_high': 'CD45_DN',
+    'Ecad_low|aSMA_low||CD45-PE_high|CD4_low|CD8a_low|Ki67-570_low': 'CD45_DN',
+    'Ecad_low|aSMA_low||CD45-PE_low|||Ki67-570_high': 'Others',
+    'Ecad_low|aSMA_low||CD45-PE_low|||Ki67-570_low': 'Others',
+}
+
+
+def iterative_gmm(expr_data, col, cluster_info=None, n_comp=2, iteration='Round_1', groups=None, **kwargs):
     """Gating using GMM with 2 or 3 components.
 
     Parameters
@@ -23,6 +59,10 @@ def iterative_gmm(expr_data, col, cluster_info=None, n_comp=2, iteration='Round_
         and column as the iteration name.
     iteration : str
         name for the columns in the cluster_info table.
+    groups : array-like or None
+        group (e.g. patient) of each cell. A separate model is fitted for each group, all in one vectorized EM pass.
+        If None, all cells are gated together.
+    **kwargs : additional arguments in 'batched_gmm', e.g. 'init' and 'random_state'.
 
     Returns
     ========
@@ -31,114 +71,393 @@ def iterative_gmm(expr_data, col, cluster_info=None, n_comp=2, iteration='Round_
         if None, a new table will be created with indices the same as the input `expr_data',
         and column as the iteration name.
     """
-    gmm = GaussianMixture(n_components=2, tol=1e-9,
-                          init_params='random', max_iter=500)
-    labels = gmm.fit_predict(expr_data[col])
-    marker_cluster_exp = expr_data[col].groupby(labels).median()
-    if n_comp == 2:
-        descriptor = ['low', 'high']
-    elif n_comp == 3:
-        descriptor = ['low', 'med', 'high']
-    else:
+    if n_comp > 3:
         print('More than 3 components is not implemented, reverting to 3 components')
-        descriptor = ['low', 'med', 'high']
         n_comp = 3
+    descriptor = gate_descriptors(n_comp)
+    values = expr_data[col].values.astype(float)
+    if groups is None:
+        group_codes = np.zeros(len(values), dtype=int)
+    else:
+        group_codes = pd.factorize(np.asarray(groups))[0]
+    labels, _ = batched_gmm(values, group_codes, n_comp=n_comp, **kwargs)
+    rank = component_rank(values, labels, group_codes, n_comp)
+    names = np.array([col[0] + '_' + keyword for keyword in descriptor], dtype=object)
     if cluster_info is None:
         cluster_info = pd.DataFrame(index=expr_data.index)
-    for cluster, keyword in zip(marker_cluster_exp.sort_values(col).index, descriptor):
-        _idx = [i for i, x in enumerate(labels) if x == cluster]
-        cluster_info.loc[expr_data.index[_idx],
-                         iteration] = col[0] + '_' + keyword
+    if cluster_info.index.equals(expr_data.index):
+        cluster_info[iteration] = names[rank]
+    else:
+        cluster_info.loc[expr_data.index, iteration] = names[rank]
     return cluster_info
 
-if __name__ == '__main__':
-    """Hard coded iterative gating, Ecad=>SMA=>CD45, with additional gating on Ki67 and gH2ax.
+
+def component_rank(values, labels, groups, n_comp):
+    """Rank of each cell's component within its group, ordered by the component medians
+    of the gated columns (first column first), i.e. 0 for the lowest expressing component.
     """
-    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
-    os.chdir(path)
-    expr = pd.read_hdf('index_corrected_tma_expr_data.hdf')
-    metadata = pd.read_csv('index_corrected_tma_metadata.csv', index_col=0)
-    channel_info = pd.read_csv(read_synapse_file(
-        'syn18555930'), index_col=0).stack()
+    medians = pd.DataFrame(values).groupby([groups, labels]).median()
+    medians.index.names = ['group', 'label']
+    medians = medians.reset_index().sort_values(['group'] + list(range(values.shape[1])))
+    rank_table = np.zeros((groups.max() + 1, n_comp), dtype=int)
+    rank_table[medians.group.values, medians.label.values] = medians.groupby('group').cumcount().values
+    return rank_table[groups, labels]
+
+
+def load_gating_tree(fn):
+    """Read a gating tree, a list of gates as in `GATING_TREE`, from a YAML or JSON file.
+    """
+    with open(fn) as f:
+        if fn.endswith('.json'):
+            import json
+            return json.load(f)
+        import yaml
+        return yaml.safe_load(f)
+
+
+def gate_descriptors(n_comp):
+    if n_comp == 2:
+        return ['low', 'high']
+    return ['low', 'med', 'high']
+
+
+def run_gating_tree(expr_data, groups, gating_tree=GATING_TREE, n_jobs=1, backend='process', instrument=None,
+                    **kwargs):
+    """Run a declarative gating tree on all groups (e.g. patients).
+
+    Gates are evaluated in order on integer cell positions: the cells of a gate are the positions
+    whose parent label matches, and only the gate's marker columns of those cells are handed to the workers.
+    Groups are split over `n_jobs` workers, each fitting all of its groups in one vectorized EM pass. Every gate is
+    warm started from a pooled fit over all groups computed up front, so the labels do not depend on n_jobs.
+
+    Parameters
+    ========
+    expr_data : pd.DataFrame
+        log2 transformed data, single cells in rows and marks in columns.
+    groups : array-like
+        group (e.g. patient) of each cell, every group is gated separately. Missing groups raise a ValueError.
+    gating_tree : list
+        gates as dicts with 'name', 'markers' and optionally 'parent', 'parent_label' and 'n_comp', see `GATING_TREE`.
+    n_jobs : int
+        number of worker processes (or threads), -1 uses all cores.
+    backend : str
+        'process' or 'thread'.
+    instrument : Instrumentation or None
+        run log with a record per gate (rows, groups, time) and per gate and group (rows, EM iterations,
+        convergence and lower bound of its model). Progress is shown per finished gate.
+    **kwargs : additional arguments in 'batched_gmm', except 'init'.
+
+    Returns
+    ========
+    cluster_info : pd.DataFrame
+        one column per gate with labels such as 'Ecad_low', empty for cells not gated by that gate.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    gate_names = [gate['name'] for gate in gating_tree]
+    for i, gate in enumerate(gating_tree):
+        if ('parent' in gate) and (gate['parent'] not in gate_names[:i]):
+            raise ValueError('Parent {} of gate {} must be defined before it'.format(
+                gate['parent'], gate['name']))
+    markers = list(dict.fromkeys(x for gate in gating_tree for x in gate['markers']))
+    values = expr_data[markers].values.astype(float)
+    instrument = Instrumentation() if instrument is None else instrument
+    group_codes, group_names = pd.factorize(np.asarray(groups))
+    if (group_codes < 0).any():
+        ungrouped = expr_data.index[group_codes < 0]
+        raise ValueError('{} cells without a group, e.g. {}'.format(len(ungrouped), list(ungrouped[:10])))
+    n_groups = group_codes.max() + 1
+    n_chunks = min(n_jobs, n_groups)
+    # contiguous blocks of groups per worker
+    chunk_of_cell = group_codes * n_chunks // n_groups
+    gate_codes = {}
+    gate_labels = {}
+    executor = ProcessPoolExecutor(n_jobs) if backend == 'process' else ThreadPoolExecutor(n_jobs)
+    with executor, instrument.span('stage', stage='gating_tree', rows=len(values), n_groups=n_groups):
+        for gate in instrument.track(gating_tree, desc='gates'):
+            n_comp = gate.get('n_comp', 2)
+            gate_labels[gate['name']] = np.array(
+                [''] + [gate['markers'][0] + '_' + x for x in gate_descriptors(n_comp)], dtype=object)
+            if 'parent' in gate:
+                parent_code = list(gate_labels[gate['parent']]).index(gate['parent_label']) - 1
+                positions = np.flatnonzero(gate_codes[gate['parent']] == parent_code)
+            else:
+                positions = np.arange(len(values))
+            with instrument.span('gate', gate=gate['name'], rows=len(positions)) as gate_record:
+                gate_values = values[np.ix_(positions, [markers.index(x) for x in gate['markers']])]
+                init = pooled_gmm_init(gate_values, n_comp, **kwargs)
+                chunks = [np.flatnonzero(chunk_of_cell[positions] == i) for i in range(n_chunks)]
+                gate_instrument = instrument.bind(gate=gate['name'])
+                jobs = [(gate_values[x], group_codes[positions[x]], group_names, n_comp, init, gate_instrument, kwargs)
+                        for x in chunks]
+                codes = np.full(len(values), -1)
+                for chunk, rank in zip(chunks, executor.map(_gate_job, jobs)):
+                    codes[positions[chunk]] = rank
+                gate_codes[gate['name']] = codes
+                gate_record['n_groups'] = len(np.unique(group_codes[positions]))
+    return pd.DataFrame({name: gate_labels[name][gate_codes[name] + 1] for name in gate_names},
+                        index=expr_data.index)
+
+
+def _gate_job(job):
+    values, groups, group_names, n_comp, init, instrument, kwargs = job
+    if len(values) == 0:
+        return np.zeros(0, dtype=int)
+    groups, group_ids = pd.factorize(groups)
+    labels, fit_info = batched_gmm(values, groups, n_comp=n_comp, init=init, **kwargs)
+    # one vectorized EM fits all groups of the chunk, so the groups are logged without a separate time
+    counts = np.bincount(groups)
+    for i, group_id in enumerate(group_ids):
+        instrument.log('patient', patient=group_names[group_id], rows=counts[i], n_iter=fit_info['n_iter'][i],
+                       converged=fit_info['converged'][i], lower_bound=fit_info['lower_bound'][i])
+    return component_rank(values, labels, groups, n_comp)
+
+
+def batched_gmm(values, groups=None, n_comp=2, init='pooled', max_iter=500, tol=1e-6, reg_covar=1e-6,
+                random_state=0, pooled_sample=100000):
+    """Fit one full covariance Gaussian mixture per group with a single vectorized EM over all groups.
+    Meant for the low dimensional (1-D, 2-D) gating models with 2-3 components.
+
+    Parameters
+    ========
+    values : np.ndarray
+        (n_cells, n_dims) data.
+    groups : np.ndarray or None
+        integer group code (0 .. n_groups - 1) of each cell, e.g. the patient. If None, one model is fitted.
+    n_comp : int
+        number of components.
+    init : str or tuple
+        'quantile' splits each group into n_comp quantile bins of the first column, 'random' uses random
+        responsibilities, 'pooled' warm starts every group from a model fitted on all cells (or `pooled_sample`
+        of them) and a (weights, means, covariances) tuple warm starts from a given model.
+    max_iter, tol, reg_covar : 
+        EM settings with the same meaning as in sklearn's GaussianMixture. Converged groups are frozen while the
+        rest continue.
+    random_state : int
+        seed for the 'random' init and the pooled subsample, so results are reproducible.
+
+    Returns
+    ========
+    labels : np.ndarray
+        most likely component of each cell.
+    fit_info : dict
+        fitted 'weights' (n_groups, n_comp), 'means' (n_groups, n_comp, n_dims) and 'covariances'
+        (n_groups, n_comp, n_dims, n_dims), with 'n_iter', 'converged' and 'lower_bound' per group.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    if groups is None:
+        groups = np.zeros(len(values), dtype=int)
+    n_groups = groups.max() + 1
+    counts = np.bincount(groups, minlength=n_groups)
+    rng = np.random.RandomState(random_state)
+    if isinstance(init, str) and (init == 'pooled'):
+        init = pooled_gmm_init(values, n_comp, pooled_sample=pooled_sample, random_state=random_state,
+                               max_iter=max_iter, tol=tol, reg_covar=reg_covar)
+    if isinstance(init, str):
+        if init == 'quantile':
+            order = np.lexsort((values[:, 0], groups))
+            group_start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            position = np.arange(len(values)) - group_start[groups[order]]
+            resp = np.zeros((len(values), n_comp))
+            resp[order, position * n_comp // counts[groups[order]]] = 1
+        elif init == 'random':
+            resp = rng.rand(len(values), n_comp)
+            resp /= resp.sum(axis=1, keepdims=True)
+        else:
+            raise ValueError('Unknown init {}'.format(init))
+        weights, means, covariances = _gmm_m_step(values, groups, resp, n_groups, counts, reg_covar)
+    else:
+        weights, means, covariances = [np.repeat(np.asarray(x, dtype=float)[None], n_groups, axis=0)
+                                       for x in init]
+
+    lower_bound = np.full(n_groups, -np.inf)
+    n_iter = np.zeros(n_groups, dtype=int)
+    converged = counts == 0
+    for _ in range(max_iter):
+        active = ~converged
+        if not active.any():
+            break
+        cells = active[groups]
+        _values, _groups = values[cells], groups[cells]
+        log_norm, resp = _gmm_e_step(_values, _groups, weights, means, covariances)
+        _lower_bound = np.bincount(_groups, log_norm, minlength=n_groups) / np.maximum(counts, 1)
+        converged[active] = np.abs(_lower_bound - lower_bound)[active] < tol
+        lower_bound[active] = _lower_bound[active]
+        n_iter[active] += 1
+        update = active & ~converged
+        _weights, _means, _covariances = _gmm_m_step(
+            _values, _groups, resp, n_groups, counts, reg_covar)
+        weights[update], means[update], covariances[update] = _weights[update], _means[update], _covariances[update]
+    log_prob = _gmm_log_prob(values, groups, weights, means, covariances)
+    fit_info = {'weights': weights, 'means': means, 'covariances': covariances,
+                'n_iter': n_iter, 'converged': converged, 'lower_bound': lower_bound}
+    return log_prob.argmax(axis=1), fit_info
+
+
+def pooled_gmm_init(values, n_comp=2, pooled_sample=100000, random_state=0, **kwargs):
+    """Fit a single model on all cells (or a random subsample of `pooled_sample` cells) to warm start
+    the per group models. Returns a (weights, means, covariances) tuple.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    if len(values) > pooled_sample:
+        rng = np.random.RandomState(random_state)
+        values = values[rng.choice(len(values), pooled_sample, replace=False)]
+    _, pooled_fit = batched_gmm(values, None, n_comp, init='quantile', **kwargs)
+    return pooled_fit['weights'][0], pooled_fit['means'][0], pooled_fit['covariances'][0]
+
+
+def _gmm_log_prob(values, groups, weights, means, covariances):
+    n_dims = values.shape[1]
+    precisions = np.linalg.inv(covariances)
+    log_det = np.linalg.slogdet(covariances)[1]
+    with np.errstate(divide='ignore'):
+        log_weights = np.log(weights)
+    log_prob = np.empty((len(values), weights.shape[1]))
+    for k in range(weights.shape[1]):
+        diff = values - means[groups, k]
+        mahalanobis = np.einsum('ni,nij,nj->n', diff, precisions[groups, k], diff)
+        log_prob[:, k] = -0.5 * (n_dims * np.log(2 * np.pi) + log_det[groups, k] + mahalanobis) + \
+            log_weights[groups, k]
+    return log_prob
+
+
+def _gmm_e_step(values, groups, weights, means, covariances):
+    log_prob = _gmm_log_prob(values, groups, weights, means, covariances)
+    log_max = log_prob.max(axis=1, keepdims=True)
+    log_norm = np.log(np.exp(log_prob - log_max).sum(axis=1, keepdims=True)) + log_max
+    return log_norm[:, 0], np.exp(log_prob - log_norm)
+
+
+def _gmm_m_step(values, groups, resp, n_groups, counts, reg_covar):
+    n_dims = values.shape[1]
+    n_comp = resp.shape[1]
+    nk = np.stack([np.bincount(groups, resp[:, k], minlength=n_groups) for k in range(n_comp)], axis=1)
+    nk += 10 * np.finfo(float).eps
+    weights = nk / np.maximum(counts, 1)[:, None]
+    means = np.empty((n_groups, n_comp, n_dims))
+    covariances = np.empty((n_groups, n_comp, n_dims, n_dims))
+    for k in range(n_comp):
+        for i in range(n_dims):
+            means[:, k, i] = np.bincount(groups, resp[:, k] * values[:, i], minlength=n_groups) / nk[:, k]
+        diff = values - means[groups, k]
+        for i in range(n_dims):
+            for j in range(i, n_dims):
+                covariances[:, k, i, j] = np.bincount(
+                    groups, resp[:, k] * diff[:, i] * diff[:, j], minlength=n_groups) / nk[:, k]
+                covariances[:, k, j, i] = covariances[:, k, i, j]
+        covariances[:, k] += reg_covar * np.eye(n_dims)
+    return weights, means, covariances
+
+
+def read_channel_names(channel_info):
+    """Channel names in Cell_Marker order from the channel info table (cycles in rows, channels in columns), given as
+    a file name or a synapse id.
+    """
+    if re.fullmatch(r'syn\d+', channel_info):
+        channel_info = read_synapse_file(channel_info)
+    return pd.read_csv(channel_info, index_col=0).stack().values
+
+
+def gate_store(store, channel_names, gating_tree=GATING_TREE, patient_sheet=None, cluster_names=None, n_jobs=1,
+               instrument=None):
+    """Gate the cells of the cell store that passed QC and store the result as the `cluster` annotation.
+
+    Parameters
+    ========
+    store : str
+        cell store folder.
+    channel_names : array-like
+        channel name of each Cell_Marker column, DNA channels are not gated.
+    gating_tree : list
+        gates, see `GATING_TREE`.
+    patient_sheet : str or None
+        excel file with one sheet per plate mapping the ROIs to `RAN_UNI` patient ids, every patient of a plate is
+        gated separately. If None, every ROI is gated separately.
+    cluster_names : dict or None
+        cluster name of every gate label combination (labels joined by '|' in gate order), e.g. `CLUSTER_NAMES` for
+        `GATING_TREE`. Combinations without a name raise a ValueError. If None, the cluster is the combination.
+    n_jobs, instrument :
+        see `run_gating_tree`.
+
+    Returns
+    ========
+    metadata : pd.DataFrame
+        Plate, ROI, CellId, labeled_as_lost and cluster of all cells, indexed by cell key.
+    """
+    # only load the non DNA channels of the cells that passed QC
+    marker_cols = ['Cell_Marker{}'.format(i) for i in range(1, len(channel_names) + 1)]
+    valid_cols = [x for x in channel_names if 'DNA' not in x]
+    valid_marker_cols = [x for x, name in zip(marker_cols, channel_names) if 'DNA' not in name]
+    cells = load_cells(store, valid_marker_cols + ['ROI', 'labeled_as_lost'],
+                       filters=[('labeled_as_lost', '==', False)])
+    expr = cells[valid_marker_cols]
+    expr.columns = valid_cols
+    metadata = cells[['Plate', 'ROI', 'CellId', 'labeled_as_lost']].copy()
+    metadata.Plate = metadata.Plate.astype(str)
     metadata['group_id'] = metadata.Plate + '_' + metadata.ROI.astype(str)
-    colnames = channel_info.values
-    expr.columns = colnames
-    valid_cells = metadata[metadata.labeled_as_lost == 'No'].index
-    valid_cols = [x for x in colnames if 'DNA' not in x]
-    expr = expr.reindex(valid_cells)[valid_cols]
-    metadata = metadata.loc[valid_cells]
-
-    cluster_info = pd.DataFrame()
-    for plate_id in ['TMA1', 'TMA2', 'TMA3', 'TMA4']:
-        plate_meta = metadata[(metadata.Plate == plate_id) & (
-            metadata.labeled_as_lost == 'No')][['ROI']]
-        patient_meta = pd.read_excel(
-            '../CMTMA_Breast_CDK4 autopsies_DEIDENTIFIED_JRL_20181119.xlsx', sheet_name=plate_id, index_col=0, dtype=str)
-        plate_meta.ROI = plate_meta.ROI.astype('int64')
-        plate_meta = plate_meta.merge(
-            patient_meta.iloc[:, :4], left_on='ROI', right_index=True, how='left')
-        plate_meta['patient'] = [x.split('-')[0] for x in plate_meta.RAN_UNI]
-        for group in plate_meta.groupby('patient'):
-            patient, patient_df = group
-            patient_expr = expr.loc[patient_df.index]
-            print('processing patient: {}'.format(patient))
-            patient_plate_meta = plate_meta[plate_meta.patient == patient]
-            # patient_umap = dimension_reduction(patient_expr, umap_n_neighbor_modifier=1000)
-
-            # Round 1
-            clustered = iterative_gmm(
-                patient_expr, ['Ecad', 'CK8-FITC'],  iteration='Ecad')
-
-            # Round 2-a
-            _current_round_data = patient_expr.loc[
-                clustered[clustered.Ecad == 'Ecad_low'].index]
-            round_name = 'Round_2a'
-            clustered = iterative_gmm(_current_round_data, [
-                                      'aSMA'], cluster_info=clustered, iteration=round_name)
-
-            # Round 2-b
-            _current_round_data = patient_expr.loc[
-                clustered[clustered.Ecad == 'Ecad_high'].index]
-            round_name = 'Round_2b'
-            clustered = iterative_gmm(_current_round_data, [
-                                      'gH2ax-PE'], cluster_info=clustered, iteration=round_name)
-
-            # Round 3
-            _current_round_data = patient_expr.loc[
-                clustered[clustered.Round_2a == 'aSMA_low'].index]
-            round_name = 'Round_3'
-            clustered = iterative_gmm(_current_round_data, [
-                                      'CD45-PE'], cluster_info=clustered, iteration=round_name)
-
-            # Round 4
-            _current_round_data = patient_expr.loc[
-                clustered[clustered.Round_3 == 'CD45-PE_high'].index]
-            clustered = iterative_gmm(_current_round_data, [
-                                      'CD4'], cluster_info=clustered, iteration='CD4')
-            clustered = iterative_gmm(_current_round_data, [
-                                      'CD8a'], cluster_info=clustered, iteration='CD8')
-
-            # Ki67 overall
-            clustered = iterative_gmm(
-                patient_expr, ['Ki67-570'], cluster_info=clustered, iteration='Ki67')
-
-            # Finalize cluster names
-            clustered.fillna('', inplace=True)
-
-            # Add patient info
-            clustered['patient'] = patient
-            cluster_info = cluster_info.append(clustered)
-
-    cluster_info['cluster_name'] = cluster_info.loc[
-        :, 'Ecad':'Ki67'].apply(lambda x: '|'.join(x.values), axis=1)
-    new_cluster_names = ['Epi|gH2_high|Ki67_high', 'Epi|gH2_high|Ki67_low', 'Epi|gH2_low|Ki67_high', 'Epi|gH2_low|Ki67_low',
-                         'Stromal|Ki67_high', 'Stromal|Ki67_low',
-                         'CD45_DP', 'CD45_DP', 'CD45_CD4', 'CD45_CD4',
-                         'CD45_CD8', 'CD45_CD8', 'CD45_DN', 'CD45_DN', 'Others', 'Others']
-    for old_cluster_name, new_name in zip(sorted(cluster_info.cluster_name.unique()), new_cluster_names):
-        cluster_info.cluster_name.replace(
-            old_cluster_name, new_name, inplace=True)
+
+    if patient_sheet is None:
+        groups = metadata.group_id.values
+    else:
+        plate_metas = []
+        for plate_id in metadata.Plate.unique():
+            plate_meta = metadata[(metadata.Plate == plate_id) & (
+                ~metadata.labeled_as_lost)][['ROI']]
+            patient_meta = pd.read_excel(patient_sheet, sheet_name=plate_id, index_col=0, dtype=str)
+            plate_meta.ROI = plate_meta.ROI.astype('int64')
+            plate_meta = plate_meta.merge(
+                patient_meta.iloc[:, :4], left_on='ROI', right_index=True, how='left')
+            plate_meta['patient'] = plate_meta.RAN_UNI.str.split('-').str[0]
+            plate_meta['plate_patient'] = plate_id + '_' + plate_meta.patient
+            plate_metas.append(plate_meta)
+        plate_meta = pd.concat(plate_metas)
+        unmapped = metadata.loc[plate_meta.index[plate_meta.patient.isnull()], 'group_id'].unique()
+        if len(unmapped) > 0:
+            raise ValueError('ROIs missing from the patient sheet: {}'.format(', '.join(sorted(unmapped))))
+        expr = expr.loc[plate_meta.index]
+        groups = plate_meta.plate_patient.values
+    cluster_info = run_gating_tree(expr, groups, gating_tree, n_jobs=n_jobs, instrument=instrument)
+
+    gates = cluster_info[[gate['name'] for gate in gating_tree]]
+    cluster_info['cluster_name'] = gates.iloc[:, 0].str.cat(
+        [gates[x] for x in gates.columns[1:]], sep='|')
+    if cluster_names is not None:
+        unnamed = sorted(set(cluster_info.cluster_name.unique()) - set(cluster_names))
+        if unnamed:
+            raise ValueError('Gate label combinations without a cluster name: {}'.format(unnamed))
+        cluster_info['cluster_name'] = cluster_info['cluster_name'].map(cluster_names)
     # Update metadata
     metadata.loc[cluster_info.index, 'cluster'] = cluster_info[
         'cluster_name'].values
-    metadata.to_csv('../results/clustered_metadata.csv')
+    write_annotation(store, 'cluster', metadata.cluster)
+    return metadata
+
+
+def export_clustered_metadata(metadata, fn):
+    """Write the metadata returned by `gate_store` as clustered_metadata.csv of the original layout, indexed by string
+    cell ids and with `labeled_as_lost` as 'Yes'/'No'.
+    """
+    metadata = metadata.set_index(cell_ids(metadata))
+    metadata['labeled_as_lost'] = metadata.labeled_as_lost.map({True: 'Yes', False: 'No'})
+    metadata.to_csv(fn)
+
+
+if __name__ == '__main__':
+    """Hard coded iterative gating, Ecad=>SMA=>CD45, with additional gating on Ki67 and gH2ax.
+    """
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
+    os.chdir(path)
+    # gates are read from gating_tree.yaml next to the data if present, otherwise GATING_TREE is used
+    gating_tree = GATING_TREE
+    if os.path.exists('gating_tree.yaml'):
+        gating_tree = load_gating_tree('gating_tree.yaml')
+    metadata = gate_store(
+        'cell_store', read_channel_names('syn18555930'), gating_tree,
+        patient_sheet='../CMTMA_Breast_CDK4 autopsies_DEIDENTIFIED_JRL_20181119.xlsx',
+        cluster_names=CLUSTER_NAMES if gating_tree == GATING_TREE else None,
+        n_jobs=-1, instrument=Instrumentation('../results/run_log.jsonl', progress=True))
+    export_clustered_metadata(metadata, '../results/clustered_metadata.csv')
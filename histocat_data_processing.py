@@ -1,35 +1,141 @@
 import pandas as pd
+import numpy as np
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import Instrumentation
 
-# Process HistoCAT outputs
-path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/histocat_output'
-os.chdir(path)
-done_plate = []
-metadata = pd.DataFrame()
-if 'expr' in locals():
-    del expr
-for fn in sorted(os.listdir(path)):
-    if 'nucleiMask' not in fn:
-        continue
-    _metadata = fn.split('_')
-    plate = _metadata[1][2:6]
-    if plate not in done_plate:
-        print(plate, fn)
-        if 'expr' in locals():
-            expr.to_csv('../processed_data/' +
-                        '_'.join([done_plate.pop(0), 'nuclei_log_normed.csv']))
-        done_plate.append(plate)
-        expr = pd.DataFrame()
-    roi = _metadata[2]
-    _data_fn = '.'.join([roi, 'csv'])
-    _df = pd.read_csv(os.path.join(path, fn, _data_fn), index_col=1)
-    _df.index = '_'.join([plate, roi, '']) + _df.index.astype(str)
-    _df_expr = _df.loc[:, 'Cell_Marker1':'Cell_Marker44']
-    _df_meta = _df.loc[:, 'Area':]
+
+def list_roi_files(path):
+    """List the histoCAT single cell tables as (plate, roi, csv file) tuples, sorted by folder name.
+    """
+    roi_files = []
+    for fn in sorted(os.listdir(path)):
+        if 'nucleiMask' not in fn:
+            continue
+        _metadata = fn.split('_')
+        plate = _metadata[1][2:6]
+        roi = _metadata[2]
+        roi_files.append((plate, roi, os.path.join(path, fn, '.'.join([roi, 'csv']))))
+    return roi_files
+
+
+def read_roi(fn):
+    """Read one histoCAT ROI table, indexed by the integer `CellId`.
+    """
+    return pd.read_csv(fn, index_col=1)
+
+
+def compact_roi(roi_df):
+    """Convert one ROI table into the compact columnar layout: float32 expression and measurements,
+    int32 CellId and no string index. Plate and ROI are stored as partition keys of the dataset. Neighbour columns are
+    always float32 (NaN for missing neighbours), so every ROI stores them with the same dtype.
+    """
+    _df = roi_df.loc[:, 'Cell_Marker1':'Cell_Marker44'].astype(np.float32)
+    _df_meta = roi_df.loc[:, 'Area':]
+    neighbour_cols = [x for x in _df_meta.columns if x.startswith('neighbour')]
+    float_cols = _df_meta.select_dtypes('float').columns.union(neighbour_cols, sort=False)
+    int_cols = _df_meta.select_dtypes('integer').columns.difference(neighbour_cols, sort=False)
+    _df_meta = _df_meta.astype(dict([(x, np.float32) for x in float_cols] + [(x, np.int32) for x in int_cols]))
+    _df = pd.concat([_df, _df_meta], axis=1)
+    _df.insert(0, 'CellId', roi_df.index.values.astype(np.int32))
+    return _df.reset_index(drop=True)
+
+
+def write_roi_partition(roi_df, out_dir, plate, roi):
+    """Write one ROI as a hive partition `Plate=<plate>/ROI=<roi>/part-0.parquet` of the dataset in out_dir.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    partition_dir = os.path.join(out_dir, 'Plate={}'.format(plate), 'ROI={}'.format(roi))
+    os.makedirs(partition_dir, exist_ok=True)
+    pq.write_table(pa.Table.from_pandas(roi_df, preserve_index=False),
+                   os.path.join(partition_dir, 'part-0.parquet'))
+
+
+def append_legacy_csv(roi_df, plate, roi, legacy_csv_dir, header):
+    """Append one ROI to the per plate expression CSV and the metadata CSV of the original layout, indexed by cell ids
+    such as `TMA1_12_345`.
+    """
+    roi_df = roi_df.set_axis('_'.join([plate, roi, '']) + roi_df.index.astype(str), axis=0)
+    _df_expr = roi_df.loc[:, 'Cell_Marker1':'Cell_Marker44']
+    _df_meta = roi_df.loc[:, 'Area':].copy()
     _df_meta['ROI'] = roi
     _df_meta['Plate'] = plate
-    expr = expr.append(_df_expr)
-    metadata = metadata.append(_df_meta)
-expr.to_csv('../processed_data/' +
-            '_'.join([done_plate.pop(0), 'nuclei_log_normed.csv']))
-metadata.to_csv('../processed_data/' + 'tma_metadata.csv')
+    _df_expr.to_csv(os.path.join(legacy_csv_dir, '_'.join([plate, 'nuclei_log_normed.csv'])),
+                    mode='w' if header['plate'] else 'a', header=header['plate'])
+    _df_meta.to_csv(os.path.join(legacy_csv_dir, 'tma_metadata.csv'),
+                    mode='w' if header['metadata'] else 'a', header=header['metadata'])
+
+
+def ingest_histocat(path, out_dir, n_jobs=1, legacy_csv_dir=None, plates=None, instrument=None):
+    """Stream all histoCAT ROI tables into a Parquet dataset partitioned by plate and ROI.
+
+    ROIs are read (with `n_jobs` reader threads), converted to compact dtypes and written one at a time, so peak
+    memory is bounded by n_jobs + 1 ROIs instead of the whole cohort.
+
+    Parameters
+    ========
+    path : str
+        histoCAT output folder.
+    out_dir : str
+        folder of the Parquet dataset.
+    n_jobs : int
+        number of ROIs read in parallel.
+    legacy_csv_dir : str or None
+        if given, the original `TMA*_nuclei_log_normed.csv` and `tma_metadata.csv` files are also written there,
+        streamed ROI by ROI.
+    plates : list or None
+        only ingest these plates, e.g. to update a single plate of an existing dataset.
+    instrument : Instrumentation or None
+        run log with a record per ROI (cells, time to convert and write) and for the whole ingestion, progress is
+        shown per ROI read.
+
+    Returns
+    ========
+    n_cells : int
+        number of ingested cells.
+    """
+    instrument = Instrumentation() if instrument is None else instrument
+    roi_files = list_roi_files(path)
+    if plates is not None:
+        roi_files = [x for x in roi_files if x[0] in plates]
+    header = {'plate': True, 'metadata': True}
+    done_plate = set()
+    n_cells = 0
+
+    def write(plate, roi, roi_df):
+        with instrument.span('roi', plate=plate, roi=roi, rows=len(roi_df)):
+            write_roi_partition(compact_roi(roi_df), out_dir, plate, roi)
+            if legacy_csv_dir is not None:
+                header['plate'] = plate not in done_plate
+                append_legacy_csv(roi_df, plate, roi, legacy_csv_dir, header)
+                header['metadata'] = False
+        if plate not in done_plate:
+            if not instrument.progress:
+                print(plate)
+            done_plate.add(plate)
+        return len(roi_df)
+
+    with ThreadPoolExecutor(n_jobs) as executor, \
+            instrument.span('stage', stage='ingest_histocat', n_rois=len(roi_files)) as stage_record:
+        pending = deque()
+        for plate, roi, fn in instrument.track(roi_files, desc='ROIs'):
+            pending.append((plate, roi, executor.submit(read_roi, fn)))
+            if len(pending) > n_jobs:
+                _plate, _roi, _future = pending.popleft()
+                n_cells += write(_plate, _roi, _future.result())
+        while pending:
+            _plate, _roi, _future = pending.popleft()
+            n_cells += write(_plate, _roi, _future.result())
+        stage_record['rows'] = n_cells
+    return n_cells
+
+
+if __name__ == '__main__':
+    # Process HistoCAT outputs
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/histocat_output'
+    os.chdir(path)
+    ingest_histocat(path, '../processed_data/cell_store/cells', n_jobs=4,
+                    legacy_csv_dir='../processed_data',
+                    instrument=Instrumentation('../results/run_log.jsonl', progress=True))
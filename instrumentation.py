@@ -0,0 +1,151 @@
+import numpy as np
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+"""Structured run log of the pipeline stages.
+
+Records are appended as JSON lines, one per finished stage, plate, gate, patient, spot or cluster, with the wall time
+(`seconds`), the peak resident memory of the writing process so far (`peak_rss_mb`), row counts and stage specific
+fields such as permutation counts or GMM iterations. Worker processes append to the same file, every record is
+written with a single write call. Load a log with `read_log` to find hot spots, e.g.
+
+    log = read_log('run_log.jsonl')
+    log[log.event == 'spot'].sort_values('seconds').tail()
+"""
+
+
+def _vm_hwm_mb():
+    """Peak resident memory of this process from /proc (Linux), None elsewhere. Unlike ru_maxrss, it is not carried
+    over from the parent of a spawned process and can be reset with `reset_peak_rss`.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process to its current size, so `peak_rss_mb` measures the code run
+    afterwards. Only possible on Linux, returns whether the peak was reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident memory in MB of this process or, if larger, of its largest finished worker process.
+    """
+    try:
+        import resource
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    children = children / 2**20 if sys.platform == 'darwin' else children / 2**10
+    peak = _vm_hwm_mb()
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+    return max(peak, children)
+
+
+def _json_default(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class Instrumentation:
+    """Writer of the run log and the optional live progress display.
+
+    The object is small and picklable, so it is handed to worker processes with the jobs. Without a `log_fn` nothing
+    is written and the spans only cost a timer call.
+
+    Parameters
+    ========
+    log_fn : str or None
+        JSONL file the records are appended to.
+    progress : bool
+        show a progress line on stderr for loops wrapped with `track`, only in the process that runs the loop.
+    **context : fields added to every record, e.g. stage='gmm' or spot='TMA1_12'.
+    """
+
+    def __init__(self, log_fn=None, progress=False, **context):
+        self.log_fn = log_fn
+        self.progress = progress
+        self.context = context
+
+    def bind(self, **context):
+        """Copy with additional context fields, e.g. for the records of a single spot.
+        """
+        return Instrumentation(self.log_fn, self.progress, **dict(self.context, **context))
+
+    def log(self, event, **fields):
+        if self.log_fn is None:
+            return
+        record = dict({'time': round(time.time(), 3), 'pid': os.getpid(), 'event': event}, **self.context)
+        record.update(fields)
+        line = json.dumps(record, default=_json_default) + '\n'
+        with open(self.log_fn, 'a') as f:
+            f.write(line)
+
+    @contextmanager
+    def span(self, event, **fields):
+        """Time the enclosed block and log it as `event` when it ends. The yielded dict is logged with the record, so
+        the block can add fields such as the number of rows it processed. A failing block is logged with its error.
+        """
+        record = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            self.log(event, seconds=round(time.perf_counter() - start, 6), peak_rss_mb=round(peak_rss_mb(), 1),
+                     **record)
+
+    def track(self, iterable, total=None, desc=''):
+        """Yield from iterable and, with `progress`, redraw a progress line with counts, rate and elapsed time.
+        """
+        if not self.progress:
+            yield from iterable
+            return
+        if total is None:
+            total = len(iterable) if hasattr(iterable, '__len__') else None
+        start = time.perf_counter()
+        done = 0
+        for item in iterable:
+            yield item
+            done += 1
+            elapsed = time.perf_counter() - start
+            sys.stderr.write('\r{}: {}{} [{:.0f}s, {:.2f}/s, peak {:.0f} MB]'.format(
+                desc, done, '' if total is None else '/{}'.format(total), elapsed, done / max(elapsed, 1e-9),
+                peak_rss_mb()))
+            sys.stderr.flush()
+        sys.stderr.write('\n')
+
+
+def read_log(log_fn):
+    """Run log as a DataFrame, one row per record.
+    """
+    import pandas as pd
+    return pd.read_json(log_fn, lines=True)
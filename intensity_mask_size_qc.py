@@ -1,27 +1,179 @@
 import pandas as pd
+import numpy as np
 import os
-from cycifsuite.detect_lost_cells import *
-from cycifsuite.common_apis import channel_histograms
-
-path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
-os.chdir(path)
-plates = ['TMA' + str(x) + '_nuclei_log_normed.csv' for x in range(1, 5)]
-metadata = pd.read_csv('tma_metadata.csv', index_col=0)
-dna_channels = np.arange(0, 44, 4)[1:]
-total_loss = []
-for plate in plates:
-    fn = plate
-    expr = pd.read_csv(fn, index_col=0)
-    expr_qc = expr.iloc[:, dna_channels]
-    expr_qc = 2**expr_qc
-    x, y, t1 = ROC_lostcells(expr_qc, n_cycles=10, cutoff_min=0, cutoff_max=1, steps=50,
-                             segmentation_cycle=1, filtering_method='cycle_diff', left_stepping=False,
-                             figname='../results/' + plate.replace('csv', 'png'))
-    _, lc_cv_down = get_lost_cells(expr_qc, t1, 10, 'cycle_diff')
-    total_loss += list(set(lc_cv_down))
-metadata = update_metadata(metadata, total_loss)
-
-# Nuclei size thresholding
-threshold = 9
-metadata.loc[metadata.Area < threshold, 'labeled_as_lost'] = 'Yes'
-metadata.to_csv('tma_metadata.csv')
+from concurrent.futures import ProcessPoolExecutor
+from cell_store import load_cells, write_annotation, read_annotation, get_plate_codes, ANNOTATION_DIR, PLATE_SHIFT
+from instrumentation import Instrumentation
+
+# DNA channels, one per cycle, as Cell_Marker columns of the cell store
+DNA_CHANNELS = ['Cell_Marker{}'.format(x + 1) for x in np.arange(0, 44, 4)[1:]]
+
+
+def min_cycle_ratio(dna_expr, segmentation_cycle=1):
+    """Smallest ratio of the DNA intensity of a cycle over the previous cycle, starting at the segmentation cycle.
+
+    Parameters
+    ========
+    dna_expr : np.ndarray
+        (n_cells, n_cycles) DNA intensities on the linear scale.
+    segmentation_cycle : int
+        first cycle (0-based) that is compared to its previous cycle.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = dna_expr[:, segmentation_cycle:] / dna_expr[:, segmentation_cycle - 1:-1]
+    return np.nan_to_num(ratios, nan=0).min(axis=1)
+
+
+def lost_cell_sweep(min_ratio, cutoff_min=0, cutoff_max=1, steps=50):
+    """Fraction of cells called lost (a cycle to cycle drop below the cutoff) for all cutoffs in one pass.
+
+    Returns
+    ========
+    cutoffs, lost_fraction : np.ndarray
+    """
+    cutoffs = np.linspace(cutoff_min, cutoff_max, steps)
+    lost_fraction = np.searchsorted(np.sort(min_ratio), cutoffs, side='left') / len(min_ratio)
+    return cutoffs, lost_fraction
+
+
+def select_cutoff(cutoffs, lost_fraction, tolerance=0.1):
+    """Cutoff in the middle of the plateau between the lost cells and the rise of the healthy cells, the 'plateau'
+    method of `plate_lost_cells`. This heuristic was only tuned on synthetic data, check it against the cycifsuite
+    calls with `compare_cutoff_methods` before using it on a new cohort.
+
+    The rise of the healthy cells starts at the knee of the sweep, the point farthest below the straight line between
+    the first and last point. Before the knee, the plateau is the longest run of steps whose increase in lost
+    fraction is at most `tolerance` times the mean increase up to the knee. Without a plateau, the flattest step is
+    used.
+    """
+    x = (cutoffs - cutoffs[0]) / (cutoffs[-1] - cutoffs[0])
+    y_range = lost_fraction[-1] - lost_fraction[0]
+    if y_range == 0:
+        return cutoffs[0]
+    y = (lost_fraction - lost_fraction[0]) / y_range
+    knee = np.argmax(x - y)
+    if knee < 2:
+        return cutoffs[knee]
+    steps = np.diff(lost_fraction[:knee + 1])
+    flat = steps <= tolerance * steps.mean()
+    if not flat.any():
+        flat = steps == steps.min()
+    # runs of flat steps as [start, end) step positions
+    edges = np.diff(np.r_[0, flat.astype(int), 0])
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    longest = np.argmax(ends - starts)
+    return cutoffs[(starts[longest] + ends[longest]) // 2]
+
+
+def plate_lost_cells(store, plate, area_threshold=9, segmentation_cycle=1, steps=50, cutoff_method='cycifsuite',
+                     figname=None, instrument=None):
+    """Lost cell QC of a single plate, reading only the DNA channels and the nuclei area from the cell store.
+    With `instrument`, the plate is logged with its time, cells, cutoff and number of lost cells.
+
+    Parameters
+    ========
+    cutoff_method : str
+        'cycifsuite' selects the cutoff and the lost cells with cycifsuite's `ROC_lostcells` and `get_lost_cells`
+        ('cycle_diff' filtering), exactly as the original script. 'plateau' uses the vectorized sweep and
+        `select_cutoff` instead, see `compare_cutoff_methods` for its agreement with cycifsuite.
+    figname : str or None
+        figure of the sweep, drawn by `ROC_lostcells` or `plot_sweep`.
+
+    Returns
+    ========
+    lost : pd.Series
+        boolean, True for cells lost during cycling or with nuclei smaller than `area_threshold`.
+    sweep : pd.Series
+        lost cell fraction by cutoff of the vectorized sweep, with the selected cutoff as name.
+    """
+    instrument = Instrumentation() if instrument is None else instrument
+    with instrument.span('plate', plate=plate, cutoff_method=cutoff_method) as plate_record:
+        cells = load_cells(store, DNA_CHANNELS + ['Area'], filters=[('Plate', '==', plate)], annotations=False)
+        dna_expr = 2 ** cells[DNA_CHANNELS].values.astype(float)
+        min_ratio = min_cycle_ratio(dna_expr, segmentation_cycle)
+        cutoffs, lost_fraction = lost_cell_sweep(min_ratio, steps=steps)
+        if cutoff_method == 'cycifsuite':
+            from cycifsuite.detect_lost_cells import ROC_lostcells, get_lost_cells
+            expr_qc = pd.DataFrame(dna_expr, index=cells.index, columns=DNA_CHANNELS)
+            _, _, cutoff = ROC_lostcells(expr_qc, n_cycles=len(DNA_CHANNELS), cutoff_min=0, cutoff_max=1, steps=steps,
+                                         segmentation_cycle=segmentation_cycle, filtering_method='cycle_diff',
+                                         left_stepping=False, figname=figname)
+            _, lost_ids = get_lost_cells(expr_qc, cutoff, len(DNA_CHANNELS), 'cycle_diff')
+            lost = cells.index.isin(list(set(lost_ids)))
+        elif cutoff_method == 'plateau':
+            cutoff = select_cutoff(cutoffs, lost_fraction)
+            lost = min_ratio < cutoff
+        else:
+            raise ValueError('Unknown cutoff_method {}'.format(cutoff_method))
+        lost |= cells.Area.values < area_threshold
+        plate_record.update(rows=len(cells), cutoff=cutoff, lost=lost.sum())
+    sweep = pd.Series(lost_fraction, index=cutoffs, name=cutoff)
+    if (cutoff_method == 'plateau') and (figname is not None):
+        plot_sweep(sweep, figname)
+    return pd.Series(lost, index=cells.index, name='labeled_as_lost'), sweep
+
+
+def compare_cutoff_methods(store, plate, **kwargs):
+    """Parity check of the 'plateau' method against the cycifsuite lost cell calls on one plate.
+
+    Returns
+    ========
+    summary : pd.Series
+        cutoff and number of lost cells of both methods, the cells called lost by both and the fraction of cells
+        with the same call. kwargs go to `plate_lost_cells`.
+    """
+    lost_cycifsuite, sweep_cycifsuite = plate_lost_cells(store, plate, cutoff_method='cycifsuite', **kwargs)
+    lost_plateau, sweep_plateau = plate_lost_cells(store, plate, cutoff_method='plateau', **kwargs)
+    return pd.Series({'cutoff_cycifsuite': sweep_cycifsuite.name, 'cutoff_plateau': sweep_plateau.name,
+                      'lost_cycifsuite': lost_cycifsuite.sum(), 'lost_plateau': lost_plateau.sum(),
+                      'lost_both': (lost_cycifsuite & lost_plateau).sum(),
+                      'agreement': (lost_cycifsuite == lost_plateau).mean()}, name=plate)
+
+
+def plot_sweep(sweep, figname):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(6, 4))
+    ax.plot(sweep.index, sweep.values)
+    ax.axvline(sweep.name, color='r', linestyle='--')
+    ax.set_xlabel('Cycle to cycle DNA ratio cutoff')
+    ax.set_ylabel('Fraction of lost cells')
+    fig.savefig(figname)
+    plt.close(fig)
+
+
+def lost_cell_qc(store, plates, n_jobs=1, figure_dir=None, instrument=None, **kwargs):
+    """Run `plate_lost_cells` for all plates in parallel worker processes and store the result as the boolean
+    `labeled_as_lost` annotation of the cell store. Calls of other plates already in the annotation are kept.
+    The sweep figures are saved as `<plate>_nuclei_log_normed.png` in figure_dir. `instrument` logs the stage and
+    every plate.
+
+    Returns
+    ========
+    sweeps : dict
+        lost cell sweep of each plate.
+    """
+    instrument = Instrumentation() if instrument is None else instrument
+    with instrument.span('stage', stage='lost_cell_qc', n_plates=len(plates)) as stage_record:
+        with ProcessPoolExecutor(n_jobs) as executor:
+            futures = [executor.submit(
+                plate_lost_cells, store, plate, instrument=instrument, figname=None if figure_dir is None else
+                os.path.join(figure_dir, plate + '_nuclei_log_normed.png'), **kwargs) for plate in plates]
+            results = [x.result() for x in instrument.track(futures, desc='plates')]
+        lost = pd.concat([x[0] for x in results])
+        stage_record.update(rows=len(lost), lost=lost.sum())
+        if os.path.exists(os.path.join(store, ANNOTATION_DIR, 'labeled_as_lost.parquet')):
+            previous = read_annotation(store, 'labeled_as_lost')
+            plate_codes = get_plate_codes(store)
+            other_plates = ~np.isin(previous.index.values >> PLATE_SHIFT, [plate_codes[x] for x in plates])
+            lost = pd.concat([previous[other_plates], lost])
+        write_annotation(store, 'labeled_as_lost', lost)
+    return dict(zip(plates, [x[1] for x in results]))
+
+
+if __name__ == '__main__':
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
+    os.chdir(path)
+    plates = ['TMA' + str(x) for x in range(1, 5)]
+    # Nuclei size thresholding at an area of 9 is applied together with the lost cell calls
+    lost_cell_qc('cell_store', plates, n_jobs=len(plates), figure_dir='../results', area_threshold=9,
+                 instrument=Instrumentation('../results/run_log.jsonl', progress=True))
@@ -1,40 +1,58 @@
 import pandas as pd
 import os
 import numpy as np
+from neighborhood_cube import load_neighborhood_cube
 
-"""Summarize neighborhood_analysis results in the following steps. This script preprocess the 
+"""Summarize neighborhood_analysis results in the following steps. This script preprocess the
 data for analysis with Morpheus.
     Mask non-significant neighhood fractions with 0.
     Add metadata for each ROI
     Output a Morpheus ready table for additional analysis with Morpheus.
 """
 
-path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/results'
-os.chdir(path)
-roi_meta = pd.read_csv('../processed_data/roi_metadata.csv', index_col=0)
-site_annotation = pd.read_excel(
-    '../processed_data/site_annotation.xlsx', index_col=0)
-roi_meta = roi_meta.merge(site_annotation, left_on='Site', right_index=True)
-pvals = pd.read_csv('neighborhood_pvalues.csv', index_col=0)
-fractions = pd.read_csv('neighborhood_fractions.csv', index_col=0).fillna(0)
-# make sure the two tables have the same columns and order
-assert((pvals.columns == fractions.columns).all())
-
-pvals.set_index(pvals.group_id + '_' + pvals.index, inplace=True)
-fractions.set_index(fractions.group_id + '_' + fractions.index, inplace=True)
-# check if indices match
-assert((pvals.index == fractions.index).all())
-
-pvals.iloc[:, :-1] = pvals.iloc[:, :-
-                                1].apply(lambda x: [True if i <= 0.05 else False for i in x.values])
-fractions.iloc[:, :-1] = fractions.iloc[:, :-1] * pvals.iloc[:, :-1]
-fractions['cluster'] = ['_'.join(x.split('_')[2:]) for x in fractions.index]
-fractions = fractions[~fractions.cluster.isin(
-    ['Others', 'CD45_DP', 'CD45_DN'])]
-fractions.drop(['Others', 'CD45_DP', 'CD45_DN'], axis=1, inplace=True)
-
-fractions = fractions.reset_index().merge(roi_meta[
-    ['group_id', 'patient', 'Site', 'organ']], on='group_id', how='left').set_index('index')
-cols = fractions.columns[-5:].tolist() + fractions.columns[:-5].tolist()
-fractions = fractions[cols]
-fractions.transpose().to_csv('neighborhood_analysis_heatmap.csv')
+# clusters left out of the heatmap, as targets and as neighbors
+EXCLUDED_CLUSTERS = ['Others', 'CD45_DP', 'CD45_DN']
+
+
+def morpheus_table(cube, roi_meta, alpha=0.05, excluded_clusters=EXCLUDED_CLUSTERS):
+    """Significant neighbor fractions with ROI metadata, read directly from the result cube.
+
+    Parameters
+    ========
+    cube : NeighborhoodCube
+        neighborhood analysis results.
+    roi_meta : pd.DataFrame
+        ROI metadata with `group_id`, `patient`, `Site` and `organ` columns.
+    alpha : float
+        fractions with a p-value above alpha are set to 0.
+
+    Returns
+    ========
+    fractions : pd.DataFrame
+        one row per spot and observed neighbor cluster, indexed `<group_id>_<neighbor cluster>`, with the group_id,
+        neighbor cluster, patient, Site and organ followed by the masked fractions of every target cluster.
+    """
+    keep_clusters = ~np.isin(cube.clusters, excluded_clusters)
+    keep_neighbors = ~np.isin(cube.neighbor_clusters, excluded_clusters)
+    values = np.nan_to_num(cube.significant_fractions(alpha)[:, keep_clusters][:, :, keep_neighbors])
+    spot_idx, neighbor_idx = np.nonzero(cube.observed()[:, keep_neighbors])
+    group_ids = cube.spots[spot_idx]
+    neighbor_clusters = cube.neighbor_clusters[keep_neighbors][neighbor_idx]
+    fractions = pd.DataFrame(values[spot_idx, :, neighbor_idx], columns=cube.clusters[keep_clusters],
+                             index=pd.Index(np.char.add(np.char.add(group_ids, '_'), neighbor_clusters)))
+    meta = roi_meta.drop_duplicates('group_id').set_index('group_id')[['patient', 'Site', 'organ']].reindex(group_ids)
+    meta.insert(0, 'cluster', neighbor_clusters)
+    meta.insert(0, 'group_id', group_ids)
+    meta.index = fractions.index
+    return pd.concat([meta, fractions], axis=1)
+
+
+if __name__ == '__main__':
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/results'
+    os.chdir(path)
+    roi_meta = pd.read_csv('../processed_data/roi_metadata.csv', index_col=0)
+    site_annotation = pd.read_excel(
+        '../processed_data/site_annotation.xlsx', index_col=0)
+    roi_meta = roi_meta.merge(site_annotation, left_on='Site', right_index=True)
+    cube = load_neighborhood_cube('neighborhood_cube.npz')
+    morpheus_table(cube, roi_meta).transpose().to_csv('neighborhood_analysis_heatmap.csv')
@@ -0,0 +1,157 @@
+import numpy as np
+import os
+from cell_store import load_cells, list_columns
+
+
+class SpotNeighbors:
+    """CSR adjacency of a single spot. Rows and neighbor positions refer to the order of the cells in the spot
+    metadata, i.e. the order in which `metadata.groupby(grouping_col)` returns them.
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    @property
+    def n_cells(self):
+        return len(self.indptr) - 1
+
+    def neighbors_of(self, rows):
+        """Unique positions of all neighbors of the cells at positions `rows` (integer or boolean array).
+        """
+        row_mask = np.zeros(self.n_cells, dtype=bool)
+        row_mask[rows] = True
+        return np.unique(self.indices[np.repeat(row_mask, np.diff(self.indptr))])
+
+
+class NeighborIndex:
+    """Integer neighbor index over all spots, replacing the string keyed lookups of histoCAT cell ids.
+
+    Parameters
+    ========
+    spots : np.ndarray
+        sorted spot names.
+    spot_ptr : np.ndarray
+        cell rows of spot `spots[i]` are `spot_ptr[i]:spot_ptr[i + 1]`.
+    indptr : np.ndarray
+        CSR row pointers over all cells, int64.
+    indices : np.ndarray
+        int32 positions of the neighbor cells within their spot.
+    """
+
+    def __init__(self, spots, spot_ptr, indptr, indices):
+        self.spots = np.asarray(spots)
+        self.spot_ptr = np.asarray(spot_ptr, dtype=np.int64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self._spot_lookup = {spot: i for i, spot in enumerate(self.spots)}
+
+    def __contains__(self, spot_name):
+        return str(spot_name) in self._spot_lookup
+
+    def spot(self, spot_name, n_cells=None):
+        """Adjacency of a single spot as a `SpotNeighbors` object. With `n_cells`, the number of cells of the spot in
+        the metadata, a spot missing from the index or indexed with a different number of cells (a stale index, e.g.
+        after a re-ingestion or ROI correction) raises a ValueError.
+        """
+        if (n_cells is not None) and (str(spot_name) not in self._spot_lookup):
+            raise ValueError('Spot {} is not in the neighbor index, rebuild the index'.format(spot_name))
+        i = self._spot_lookup[str(spot_name)]
+        start, stop = self.spot_ptr[i], self.spot_ptr[i + 1]
+        if (n_cells is not None) and (stop - start != n_cells):
+            raise ValueError('Neighbor index has {} cells for spot {} but the metadata has {}, rebuild the '
+                             'index'.format(stop - start, spot_name, n_cells))
+        indptr = self.indptr[start:stop + 1]
+        return SpotNeighbors(indptr - indptr[0], self.indices[indptr[0]:indptr[-1]])
+
+    def save(self, fn):
+        np.savez(fn, spots=self.spots.astype(str), spot_ptr=self.spot_ptr,
+                 indptr=self.indptr, indices=self.indices)
+
+
+def load_neighbor_index(fn):
+    with np.load(fn) as data:
+        return NeighborIndex(data['spots'], data['spot_ptr'], data['indptr'], data['indices'])
+
+
+def spot_adjacency(cell_numbers, neighbour_values):
+    """Turn the histoCAT `neighbour` columns of one spot into CSR arrays.
+
+    Parameters
+    ========
+    cell_numbers : np.ndarray
+        histoCAT cell number of each cell in the spot.
+    neighbour_values : np.ndarray
+        (n_cells, n_neighbour_cols) cell numbers of the neighbors, 0 or NaN when absent. Neighbors that are not
+        part of the spot (e.g. removed cells) are dropped.
+
+    Returns
+    ========
+    indptr, indices : np.ndarray
+        CSR row pointers and int32 neighbor positions within the spot.
+    """
+    order = np.argsort(cell_numbers, kind='stable')
+    sorted_numbers = cell_numbers[order]
+    valid = ~np.isnan(neighbour_values) & (neighbour_values != 0)
+    targets = np.searchsorted(sorted_numbers, np.where(valid, neighbour_values, 0))
+    targets = np.minimum(targets, len(sorted_numbers) - 1)
+    valid &= sorted_numbers[targets] == neighbour_values
+    indptr = np.zeros(len(cell_numbers) + 1, dtype=np.int64)
+    np.cumsum(valid.sum(axis=1), out=indptr[1:])
+    return indptr, order[targets[valid]].astype(np.int32)
+
+
+def build_neighbor_index(metadata, grouping_col='group_id'):
+    """One-time conversion of the histoCAT `neighbour` columns into a `NeighborIndex`.
+    The histoCAT cell numbers are taken from the `CellId` column if present (cell store tables), otherwise from the
+    cell ids, e.g. 345 for `TMA1_12_345`.
+    """
+    neighbour_cols = [x for x in metadata.columns if 'neighbour' in x]
+    if 'CellId' in metadata.columns:
+        cell_numbers = metadata.CellId.values.astype(np.int64)
+    else:
+        cell_numbers = metadata.index.astype(str).str.rsplit(
+            '_', n=1).str[-1].astype(np.int64).values
+    neighbour_values = metadata[neighbour_cols].values.astype(float)
+    spot_rows = metadata.groupby(grouping_col).indices
+    spots = sorted(spot_rows.keys())
+    adjacencies = (spot_adjacency(cell_numbers[spot_rows[spot]], neighbour_values[spot_rows[spot]])
+                   for spot in spots)
+    return index_from_adjacencies(spots, adjacencies)
+
+
+def index_from_adjacencies(spots, adjacencies):
+    """Concatenate the per spot CSR arrays (indptr, indices) of the sorted `spots` into a `NeighborIndex`.
+    """
+    spot_ptr = np.zeros(len(spots) + 1, dtype=np.int64)
+    indptr_list = [np.zeros(1, dtype=np.int64)]
+    indices_list = []
+    nnz = 0
+    for i, (_indptr, _indices) in enumerate(adjacencies):
+        indptr_list.append(_indptr[1:] + nnz)
+        indices_list.append(_indices)
+        nnz += len(_indices)
+        spot_ptr[i + 1] = spot_ptr[i] + len(_indptr) - 1
+    indices = np.concatenate(indices_list) if indices_list else np.zeros(0, dtype=np.int32)
+    return NeighborIndex(np.array(spots).astype(str), spot_ptr, np.concatenate(indptr_list), indices)
+
+
+def build_store_index(store, fn):
+    """Build the neighbor index of the cells of the cell store that passed the QC (as in clustered_metadata.csv),
+    grouped by `<plate>_<roi>` with the ROIs as currently annotated, and save it to `fn`. Lost cells are neither
+    indexed nor neighbors.
+    """
+    neighbour_cols = [x for x in list_columns(store) if 'neighbour' in x]
+    metadata = load_cells(store, ['ROI'] + neighbour_cols, filters=[('labeled_as_lost', '==', False)])
+    metadata['group_id'] = metadata.Plate.astype(str) + '_' + metadata.ROI.astype(str)
+    neighbor_index = build_neighbor_index(metadata)
+    neighbor_index.save(fn)
+    return neighbor_index
+
+
+if __name__ == '__main__':
+    """Build the neighbor index next to the cell store.
+    """
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
+    os.chdir(path)
+    build_store_index('cell_store', 'neighbor_index.npz')
@@ -1,13 +1,26 @@
 import pandas as pd
 import numpy as np
 import os
+import zlib
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from neighbor_index import build_store_index, load_neighbor_index
+from cell_store import load_cells
+from instrumentation import Instrumentation
+from neighborhood_cube import NeighborhoodCube
 
+# version of the per-spot results in the cache, part of the cache keys
+RESULT_VERSION = 4
 
-def neighborhood_analysis(metadata, grouping_col='group_id', cluster_col='cluster', **kwargs):
+
+def neighborhood_analysis(metadata, grouping_col='group_id', cluster_col='cluster', neighbor_index=None,
+                          n_jobs=1, backend='process', random_state=None, cache_dir=None, instrument=None, **kwargs):
     """Overall script for neighborhood analysis.
     Each spot is analyzed separately. Neighbors of each cluster within were evaluated individually
     and sequentially. Neighbor cells of each single cell within a cluster are pooled and considered neighbors
-    of that particular cluster. Pvalues estimated by permutation analysis and the raw fractions are exported.
+    of that particular cluster. Pvalues estimated by permutation analysis and the raw fractions are written into a
+    dense result cube as soon as a spot finishes.
 
     Parameters
     ========
@@ -16,43 +29,187 @@ def neighborhood_analysis(metadata, grouping_col='group_id', cluster_col='cluste
         columns from histoCAT analysis.
     (grouping, cluster)_col : str
         column names in the metadata table containing the spot information and the cluster information.
-    **kwargs : additional arguments in 'permutation_neighborhood' function, where 'num_permutations' controls
-        numbers of permutations.
+    neighbor_index : NeighborIndex or None
+        precomputed integer neighbor index built from the same metadata table by `build_neighbor_index`. If None,
+        neighbors are looked up through the histoCAT cell ids in the `neighbour` columns.
+    n_jobs : int
+        number of spots analyzed in parallel, -1 uses all cores.
+    backend : str
+        'process' or 'thread', the pool used when n_jobs is not 1. Each worker only receives the columns of its own
+        spot that the analysis needs.
+    random_state : int or None
+        seed of the permutations. Every spot gets its own random stream derived from the seed and the spot name, so
+        results do not depend on n_jobs. If None, a single process run uses the global numpy random state as before.
+    cache_dir : str or None
+        folder of the per-spot result store. Results are saved there as soon as a spot finishes, keyed on a hash of
+        the spot's cluster labels, neighbors and the permutation parameters. Spots whose key is already stored are
+        not recomputed, so reruns only analyze changed spots and an interrupted run resumes where it stopped.
+        Requires `random_state`.
+    instrument : Instrumentation or None
+        run log of the analysis, with a record per spot (rows, clusters, time, cached or not) and per cluster (rows,
+        tested neighbor clusters, permutations). Progress is shown per finished spot.
+    **kwargs : additional arguments in 'permutation_test_codes' function, where 'num_permutations' controls
+        numbers of permutations and 'chunk_size' the number of permutations evaluated together. 'sequential',
+        'alpha', 'h' and 'max_permutations' control the adaptive permutation test.
 
     Returns
     ========
-    pval_report : pd.DataFrame
-        a table containing all estimated pvalues of getting the observed neighbor fraction by chance. 
-    fraction_report : pd.DataFrame
-        a table containing all observed neighborhood fractions. 
+    cube : NeighborhoodCube
+        p-values, observed neighbor fractions and permutation counts of every spot, target cluster and neighbor
+        cluster. `cube.to_reports()` gives the original p-value, fraction and permutation tables.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if (random_state is None) & (cache_dir is not None):
+        raise ValueError('cache_dir requires a fixed random_state')
+    if (random_state is None) & (n_jobs != 1):
+        random_state = np.random.randint(2**31)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    instrument = Instrumentation() if instrument is None else instrument
+    spot_keys = {}
+    spot_cols = [cluster_col]
+    if cluster_col != 'cluster':
+        spot_cols.append('cluster')
+    if neighbor_index is None:
+        spot_cols += [x for x in metadata.columns if 'neighbour' in x]
+
+    spot_groups = metadata.groupby(grouping_col)
+    cube = NeighborhoodCube(np.unique(metadata[grouping_col].dropna().astype(str)),
+                            np.unique(metadata[cluster_col].dropna().astype(str)),
+                            np.unique(metadata.cluster.dropna().astype(str)))
+
+    def spot_jobs():
+        for group_name, group_df in spot_groups:
+            spot_neighbors = None if neighbor_index is None else neighbor_index.spot(group_name, len(group_df))
+            if cache_dir is not None:
+                spot_key = get_spot_cache_key(
+                    group_df[spot_cols], spot_neighbors, group_name, random_state, kwargs)
+                spot_keys[group_name] = spot_key
+                if os.path.exists(get_spot_cache_fn(cache_dir, group_name, spot_key)):
+                    instrument.log('spot', spot=group_name, rows=len(group_df), cached=True)
+                    continue
+            spot_random_state = None if random_state is None else get_spot_random_state(
+                random_state, group_name)
+            yield (group_name, group_df[spot_cols], cluster_col, spot_neighbors, spot_random_state,
+                   instrument.bind(spot=group_name), kwargs)
+
+    with instrument.span('stage', stage='neighborhood_analysis', rows=len(metadata), n_spots=spot_groups.ngroups):
+        if n_jobs == 1:
+            spot_results = map(_spot_job, spot_jobs())
+        else:
+            spot_results = ordered_pool_map(_spot_job, spot_jobs(), n_jobs, backend)
+        if cache_dir is not None:
+            # cached spots are not counted in the progress
+            for group_name, spot_result in instrument.track(spot_results, desc='spots'):
+                store_spot_result(cache_dir, group_name, spot_keys[group_name], spot_result)
+            # assemble the cube from the store
+            spot_results = ((group_name, pd.read_pickle(get_spot_cache_fn(cache_dir, group_name, spot_key)))
+                            for group_name, spot_key in spot_keys.items())
+        else:
+            spot_results = instrument.track(spot_results, spot_groups.ngroups, 'spots')
+        for group_name, spot_result in spot_results:
+            cube.fill_spot(group_name, spot_result)
+    return cube
+
+
+def spot_neighborhood(group_df, cluster_col='cluster', spot_neighbors=None, instrument=None, **kwargs):
+    """Neighborhood analysis of all clusters within a single spot. The cells are encoded once and every target
+    cluster is tested with `permutation_test_codes`, sharing the spot's random stream in cluster order. With
+    `instrument`, the spot and every cluster are logged with their time, cell counts and permutation counts.
+
+    Returns
+    ========
+    spot_result : dict
+        'clusters' (target clusters of the spot), 'neighbor_clusters' (all clusters of the spot) and the (clusters,
+        neighbor_clusters) arrays 'pvals', 'fractions' and 'permutations', see `NeighborhoodCube.fill_spot`.
+    """
+    instrument = Instrumentation() if instrument is None else instrument
+    codes, neighbor_clusters = encode_clusters(group_df.cluster.values)
+    target_codes, clusters = encode_clusters(group_df[cluster_col].values)
+    shape = (len(clusters), len(neighbor_clusters))
+    spot_result = {'clusters': clusters, 'neighbor_clusters': neighbor_clusters, 'pvals': np.ones(shape),
+                   'fractions': np.zeros(shape), 'permutations': np.zeros(shape, dtype=np.int32)}
+    with instrument.span('spot', rows=len(group_df), n_clusters=len(clusters), cached=False):
+        for i, cluster_name in enumerate(clusters):
+            target_rows = np.flatnonzero(target_codes == i)
+            with instrument.span('cluster', cluster=cluster_name, rows=len(target_rows)) as cluster_record:
+                neighbor_pos = target_neighbor_positions(group_df, target_rows, spot_neighbors)
+                pval, true_fractions, n_permutations = permutation_test_codes(
+                    codes, neighbor_pos, len(neighbor_clusters), **kwargs)
+                observed = true_fractions > 0
+                spot_result['pvals'][i, observed] = pval[observed]
+                spot_result['fractions'][i, observed] = true_fractions[observed]
+                spot_result['permutations'][i, observed] = n_permutations[observed]
+                cluster_record.update(neighbor_clusters=observed.sum(), permutations=n_permutations[observed].sum(),
+                                      max_permutations=n_permutations[observed].max(initial=0))
+    return spot_result
+
+
+def _spot_job(job):
+    group_name, group_df, cluster_col, spot_neighbors, random_state, instrument, kwargs = job
+    return group_name, spot_neighborhood(group_df, cluster_col, spot_neighbors, instrument=instrument,
+                                         random_state=random_state, **kwargs)
+
+
+def get_spot_random_state(random_state, spot_name):
+    """Independent random stream of a spot, derived from the seed and the spot name only.
     """
+    seed_seq = np.random.SeedSequence(
+        random_state, spawn_key=(zlib.crc32(str(spot_name).encode()),))
+    return np.random.RandomState(np.random.MT19937(seed_seq))
 
-    pval_report = pd.DataFrame()
-    fraction_report = pd.DataFrame()
-    for _group in metadata.groupby(grouping_col):
-        group_name, group_df = _group
-        group_pvals = pd.DataFrame()
-        group_fractions = pd.DataFrame()
-        for _cluster_group in group_df.groupby(cluster_col):
-            cluster_name, cluster_df = _cluster_group
-            cluster_neighbor_pvals, _neighbor_fractions = permutation_neighborhood(
-                cluster_df, group_df, **kwargs)
-            cluster_neighbor_pvals = pd.DataFrame(
-                cluster_neighbor_pvals, columns=[cluster_name])
-            group_pvals = pd.concat(
-                [group_pvals, cluster_neighbor_pvals], axis=1, sort=False)
-            _neighbor_fractions.name = cluster_name
-            group_fractions = pd.concat(
-                [group_fractions, _neighbor_fractions], axis=1, sort=False)
-        # record p-values
-        group_pvals[grouping_col] = group_name
-        group_pvals.fillna(1, inplace=True)
-        pval_report = pval_report.append(group_pvals, sort=False)
-        # record detailed neighbor fractions
-        group_fractions.fillna(0, inplace=True)
-        group_fractions[grouping_col] = group_name
-        fraction_report = fraction_report.append(group_fractions, sort=False)
-    return pval_report, fraction_report
+
+def get_spot_cache_key(spot_df, spot_neighbors, spot_name, random_state, params):
+    """Content hash of everything that determines the result of a spot.
+    """
+    sha = hashlib.sha1()
+    sha.update(repr(spot_df.columns.tolist()).encode())
+    sha.update(pd.util.hash_pandas_object(spot_df, index=True).values.tobytes())
+    if spot_neighbors is not None:
+        sha.update(spot_neighbors.indptr.tobytes())
+        sha.update(spot_neighbors.indices.tobytes())
+    # chunk_size and verbose do not change the results
+    params = sorted((k, v) for k, v in params.items() if k not in ['chunk_size', 'verbose'])
+    sha.update(repr((RESULT_VERSION, str(spot_name), random_state, params)).encode())
+    return sha.hexdigest()
+
+
+def get_spot_cache_fn(cache_dir, spot_name, spot_key):
+    return os.path.join(cache_dir, '{}.{}.pkl'.format(spot_name, spot_key))
+
+
+def store_spot_result(cache_dir, spot_name, spot_key, spot_result):
+    """Atomically write the result of a spot and remove results of the same spot with outdated keys.
+    """
+    fn = get_spot_cache_fn(cache_dir, spot_name, spot_key)
+    pd.to_pickle(spot_result, fn + '.tmp')
+    os.replace(fn + '.tmp', fn)
+    for old_fn in os.listdir(cache_dir):
+        if (not old_fn.endswith('.pkl')) | (old_fn == os.path.basename(fn)):
+            continue
+        if old_fn[:-len('.pkl')].rsplit('.', 1)[0] == str(spot_name):
+            os.remove(os.path.join(cache_dir, old_fn))
+
+
+def ordered_pool_map(func, jobs, n_jobs, backend='process'):
+    """Run `func` over `jobs` in a process or thread pool and yield the results in submission order.
+    At most 2 * n_jobs jobs are in flight, so only a few spots are held in memory at a time.
+    """
+    if backend == 'process':
+        executor = ProcessPoolExecutor(n_jobs)
+    elif backend == 'thread':
+        executor = ThreadPoolExecutor(n_jobs)
+    else:
+        raise ValueError('Unknown backend {}, use "process" or "thread"'.format(backend))
+    with executor:
+        pending = deque()
+        for job in jobs:
+            pending.append(executor.submit(func, job))
+            if len(pending) >= 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def get_neighbors(neighbour_metadata, exclude_self=True):
@@ -70,58 +227,209 @@ def get_neighbors(neighbour_metadata, exclude_self=True):
 
 
 def annotate_neighbors(neighbour_idx, metadata):
-    neighbors = metadata.reindex(neighbour_idx).dropna(
-        how='all').cluster.value_counts()
+    if isinstance(neighbour_idx, np.ndarray) and neighbour_idx.dtype.kind in 'iu':
+        # integer positions from a NeighborIndex
+        neighbors = metadata.cluster.iloc[neighbour_idx].value_counts()
+    else:
+        neighbors = metadata.reindex(neighbour_idx).dropna(
+            how='all').cluster.value_counts()
     total_neighbors = neighbors.sum()
     neighbour_fractions = neighbors / total_neighbors
     return neighbour_fractions.sort_index()
 
 
-def neighbor_across_spots(metadata, target_cluster, spot_col='group_id', cluster_col='cluster'):
+def neighbor_across_spots(metadata, target_cluster, spot_col='group_id', cluster_col='cluster', neighbor_index=None):
     """Get neighbor information for the target cluster across all the spots available in the metadata sheet.
+    If a `NeighborIndex` built from the same metadata is given, neighbors are resolved by integer positions.
     """
-    all_spots = metadata[spot_col].unique()
-    neighbor_summary = pd.DataFrame()
+    neighbor_summary = []
     for _group in metadata.groupby(spot_col):
         spot_name, spot_metadata = _group
-        spot_metadata = spot_metadata[spot_metadata.cluster == target_cluster]
-        if spot_metadata.shape[0] == 0:
+        target_rows = (spot_metadata.cluster == target_cluster).values
+        if not target_rows.any():
             continue
-        cluster_neighbors = get_neighbors(spot_metadata)
-        annotated_neighbors = annotate_neighbors(cluster_neighbors, metadata)
+        if neighbor_index is None:
+            cluster_neighbors = get_neighbors(spot_metadata[target_rows])
+            annotated_neighbors = annotate_neighbors(cluster_neighbors, metadata)
+        else:
+            cluster_neighbors = neighbor_index.spot(spot_name, len(spot_metadata)).neighbors_of(target_rows)
+            annotated_neighbors = annotate_neighbors(cluster_neighbors, spot_metadata)
         annotated_neighbors.name = spot_name
-        annotated_neighbors = pd.DataFrame(annotated_neighbors).transpose()
-        neighbor_summary = neighbor_summary.append(annotated_neighbors)
-    return neighbor_summary.fillna(0)
+        neighbor_summary.append(annotated_neighbors)
+    return pd.concat(neighbor_summary, axis=1, sort=False).transpose().fillna(0)
+
 
+def encode_clusters(cluster_labels):
+    """Encode cluster labels as integer codes once per spot.
+
+    Parameters
+    ========
+    cluster_labels : array-like
+        cluster label of every cell in the spot. Missing labels (NaN) are allowed.
 
-def permutation_neighborhood(target_metadata, spot_metadata, num_permutations=1000, verbose=False):
+    Returns
+    ========
+    codes : np.ndarray
+        integer code of each cell. Cells without a label get code `len(clusters)`, so they still take part in the
+        permutations but are never counted as neighbors.
+    clusters : np.ndarray
+        sorted unique cluster labels, indexed by code.
+    """
+    codes, clusters = pd.factorize(pd.Series(cluster_labels), sort=True)
+    codes = np.where(codes < 0, len(clusters), codes)
+    return codes, np.asarray(clusters)
+
+
+def permuted_neighbor_counts(codes, neighbor_pos, n_clusters, permutations):
+    """Count neighbor clusters for a block of permutations at once.
+
+    Parameters
+    ========
+    codes : np.ndarray
+        integer cluster codes of all cells in the spot, as returned by `encode_clusters`.
+    neighbor_pos : np.ndarray
+        integer positions (within the spot) of the neighbor cells.
+    n_clusters : int
+        number of real clusters, code `n_clusters` is reserved for unlabeled cells.
+    permutations : np.ndarray
+        (n_permutations, n_cells) array of permuted cell positions.
+
+    Returns
+    ========
+    counts : np.ndarray
+        (n_permutations, n_clusters) array of neighbor counts per cluster.
+    """
+    n_bins = n_clusters + 1
+    permuted_codes = codes[permutations[:, neighbor_pos]]
+    offsets = np.arange(permutations.shape[0])[:, None] * n_bins
+    counts = np.bincount((permuted_codes + offsets).ravel(),
+                         minlength=permutations.shape[0] * n_bins)
+    return counts.reshape(-1, n_bins)[:, :n_clusters]
+
+
+def permutation_test_codes(codes, neighbor_pos, n_clusters, num_permutations=1000, chunk_size=100,
+                           random_state=None, verbose=False, sequential=False, alpha=0.05, h=10,
+                           max_permutations=10000, z=2.58):
+    """Permutation test on integer encoded cells, the engine behind `permutation_neighborhood`.
+
+    Permutations are drawn one by one from `random_state` exactly as `np.random.permutation` on the cluster labels
+    would, so results are identical to permuting the labels themselves under the same seed. Neighbor counts are
+    computed `chunk_size` permutations at a time, which bounds the memory to a (chunk_size, n_cells) array.
+
+    With `sequential=True` the number of permutations adapts per neighbor cluster (Besag-Clifford style). Counting
+    stops for a cluster once it had `h` permutations at least as extreme as observed while the z-score confidence
+    interval of its p-value lies above `alpha`, or, after `num_permutations`, once that interval excludes `alpha`.
+    Borderline clusters, whose interval still contains `alpha`, continue up to `max_permutations`. Chunks start small
+    and double up to chunk_size, so clearly non significant clusters stop after a few dozen permutations.
+
+    Returns
+    ========
+    pval : np.ndarray
+        fraction of permutations with a neighbor fraction at least as high as observed, per cluster.
+    true_fractions : np.ndarray
+        observed neighbor fraction per cluster.
+    n_permutations : np.ndarray
+        number of permutations each p-value is based on.
+    """
+    rng = np.random.mtrand._rand if random_state is None else random_state
+    if not isinstance(rng, np.random.RandomState):
+        rng = np.random.RandomState(rng)
+    n_cells = len(codes)
+    true_counts = np.bincount(codes[neighbor_pos], minlength=n_clusters + 1)[:n_clusters]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        true_fractions = true_counts / true_counts.sum()
+    exceed = np.zeros(n_clusters, dtype=int)
+    n_permutations = np.zeros(n_clusters, dtype=int)
+    # clusters that are not observed as neighbors are not tested
+    active = true_fractions > 0 if sequential else np.ones(n_clusters, dtype=bool)
+    total = max_permutations if sequential else num_permutations
+    n_chunk = min(chunk_size, 2 * h) if sequential else chunk_size
+    start = 0
+    while (start < total) & active.any():
+        n_chunk = min(n_chunk, total - start)
+        permutations = np.empty((n_chunk, n_cells), dtype=np.intp)
+        for i in range(n_chunk):
+            permutations[i] = rng.permutation(n_cells)
+        counts = permuted_neighbor_counts(codes, neighbor_pos, n_clusters, permutations)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fractions = counts / counts.sum(axis=1, keepdims=True)
+        exceed += np.where(active, (true_fractions <= fractions).sum(axis=0), 0)
+        n_permutations += np.where(active, n_chunk, 0)
+        start += n_chunk
+        if sequential:
+            pval = exceed / n_permutations.clip(1)
+            margin = z * np.sqrt(pval * (1 - pval) / n_permutations.clip(1))
+            decided = (exceed >= h) & (pval - margin > alpha)
+            decided |= (n_permutations >= num_permutations) & (np.abs(pval - alpha) > margin)
+            active &= ~decided
+            n_chunk = min(2 * n_chunk, chunk_size)
+        if verbose:
+            print('Iteration: {}, active clusters: {}'.format(str(start), str(active.sum())))
+    return exceed / n_permutations.clip(1), true_fractions, n_permutations
+
+
+def target_neighbor_positions(spot_metadata, target_rows, spot_neighbors=None):
+    """Positions of the neighbor cells of the cells at positions `target_rows` within the spot, from the
+    `SpotNeighbors` of the spot if given, otherwise from the histoCAT cell ids in the `neighbour` columns.
+    """
+    if spot_neighbors is not None:
+        return spot_neighbors.neighbors_of(target_rows)
+    neighbors = get_neighbors(spot_metadata.iloc[target_rows], exclude_self=False)
+    neighbor_pos = spot_metadata.index.get_indexer(neighbors)
+    return neighbor_pos[neighbor_pos >= 0]
+
+
+def permutation_neighborhood(target_metadata, spot_metadata, num_permutations=1000, verbose=False,
+                             chunk_size=100, random_state=None, spot_neighbors=None, return_permutations=False,
+                             **kwargs):
     """Permutate cluster labels in the spot_metadata table to get a null distribution of observing the neighbor by cluster profile by chance. 
+    Cells and clusters are encoded as integer codes once and the permutations are evaluated in blocks of
+    `chunk_size`, see `permutation_test_codes`, which also takes the sequential testing arguments in `kwargs`.
+    If `spot_neighbors` (the `SpotNeighbors` of the spot) is given, the neighbors are taken from the integer
+    adjacency instead of the `neighbour` columns. With `return_permutations`, the number of permutations of each
+    p-value is returned as third value.
     """
-    neighbors = get_neighbors(target_metadata, exclude_self=False)
-    true_neighbor_fractions = annotate_neighbors(neighbors, spot_metadata)
-    pval = pd.Series(0, index=true_neighbor_fractions.index)
-    for i in range(num_permutations):
-        permuted_cluster = np.random.permutation(spot_metadata.cluster.values)
-        permuted_data = spot_metadata.copy()
-        permuted_data.loc[:, 'cluster'] = permuted_cluster
-        permutated_neighbor_fractions = annotate_neighbors(
-            neighbors, permuted_data)
-        permutated_neighbor_fractions = permutated_neighbor_fractions.reindex(
-            true_neighbor_fractions.index, fill_value=0)
-        pval += (true_neighbor_fractions <= permutated_neighbor_fractions)
-        if (i % 100 == 0) & (verbose):
-            print('Iteration: {}'.format(str(i)))
-            print(permutated_neighbor_fractions)
-    return pval / num_permutations, true_neighbor_fractions
+    neighbor_pos = target_neighbor_positions(
+        spot_metadata, spot_metadata.index.get_indexer(target_metadata.index), spot_neighbors)
+    codes, clusters = encode_clusters(spot_metadata.cluster.values)
+    pval, true_fractions, n_permutations = permutation_test_codes(
+        codes, neighbor_pos, len(clusters), num_permutations=num_permutations, chunk_size=chunk_size,
+        random_state=random_state, verbose=verbose, **kwargs)
+    observed = true_fractions > 0
+    true_neighbor_fractions = pd.Series(
+        true_fractions[observed], index=pd.Index(clusters[observed], name='cluster'), name='cluster')
+    pval = pd.Series(pval[observed], index=true_neighbor_fractions.index)
+    if return_permutations:
+        return pval, true_neighbor_fractions, pd.Series(n_permutations[observed], index=true_neighbor_fractions.index)
+    return pval, true_neighbor_fractions
+
+
+def analyze_store(store, index_fn, results_dir, n_jobs=1, random_state=0, cache_dir=None, instrument=None,
+                  **kwargs):
+    """Neighborhood analysis of the clustered cells of the cell store (cells that passed the QC, with the same filter
+    as `build_store_index` so the index positions line up), saving the result cube as
+    `neighborhood_cube.npz` in results_dir. The neighbor index is loaded from `index_fn`, or built and saved there if
+    it does not exist. **kwargs go to `neighborhood_analysis`.
+    """
+    if os.path.exists(index_fn):
+        neighbor_index = load_neighbor_index(index_fn)
+    else:
+        neighbor_index = build_store_index(store, index_fn)
+    metadata = load_cells(store, ['ROI', 'cluster'], filters=[('labeled_as_lost', '==', False)])
+    metadata['group_id'] = metadata.Plate.astype(str) + '_' + metadata.ROI.astype(str)
+    cube = neighborhood_analysis(
+        metadata, neighbor_index=neighbor_index, n_jobs=n_jobs, random_state=random_state,
+        cache_dir=cache_dir, instrument=instrument, **kwargs)
+    cube.save(os.path.join(results_dir, 'neighborhood_cube.npz'))
+    return cube
+
 
 if __name__ == '__main__':
     """Hard coded neighborhood analysis with default parameters.
     """
     path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
     os.chdir(path)
-    metadata = pd.read_csv('clustered_metadata.csv', index_col=0)
-    metadata['group_id'] = metadata.Plate + '_' + metadata.ROI.astype(str)
-    pvals, fractions = neighborhood_analysis(metadata)
-    pvals.to_csv('../results/neighborhood_pvalues.csv')
-    fractions.to_csv('../results/neighborhood_fractions.csv')
+    analyze_store('cell_store', 'neighbor_index.npz', '../results', n_jobs=-1, random_state=0,
+                  cache_dir='../results/neighborhood_cache',
+                  instrument=Instrumentation('../results/run_log.jsonl', progress=True),
+                  sequential=True, alpha=0.05, max_permutations=10000)
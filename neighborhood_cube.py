@@ -0,0 +1,80 @@
+import pandas as pd
+import numpy as np
+
+
+class NeighborhoodCube:
+    """Dense results of the neighborhood analysis, replacing the long p-value, fraction and permutation tables.
+
+    Entry [s, i, j] refers to the cells of cluster `clusters[i]` in spot `spots[s]` and their neighbors of cluster
+    `neighbor_clusters[j]`. Target clusters absent from a spot and neighbor clusters absent from a spot are NaN (0
+    permutations). Neighbor clusters present in the spot but not observed as neighbors of a target have a p-value of 1
+    and a fraction of 0, as in the original reports.
+
+    Parameters
+    ========
+    spots, clusters, neighbor_clusters : np.ndarray
+        labels of the three axes.
+    pvals, fractions : np.ndarray
+        float32 (n_spots, n_clusters, n_neighbor_clusters) arrays, filled with NaN if not given.
+    permutations : np.ndarray
+        int32 number of permutations behind each p-value, zeros if not given.
+    """
+
+    def __init__(self, spots, clusters, neighbor_clusters, pvals=None, fractions=None, permutations=None):
+        self.spots = np.asarray(spots).astype(str)
+        self.clusters = np.asarray(clusters).astype(str)
+        self.neighbor_clusters = np.asarray(neighbor_clusters).astype(str)
+        shape = (len(self.spots), len(self.clusters), len(self.neighbor_clusters))
+        self.pvals = np.full(shape, np.nan, dtype=np.float32) if pvals is None else pvals
+        self.fractions = np.full(shape, np.nan, dtype=np.float32) if fractions is None else fractions
+        self.permutations = np.zeros(shape, dtype=np.int32) if permutations is None else permutations
+        self._spot_lookup = {spot: i for i, spot in enumerate(self.spots)}
+
+    def fill_spot(self, spot_name, spot_result):
+        """Write the result of one spot, a dict with its 'clusters', 'neighbor_clusters' and the (clusters,
+        neighbor_clusters) 'pvals', 'fractions' and 'permutations' arrays, into the cube.
+        """
+        s = self._spot_lookup[str(spot_name)]
+        rows = np.searchsorted(self.clusters, np.asarray(spot_result['clusters']).astype(str))
+        cols = np.searchsorted(self.neighbor_clusters, np.asarray(spot_result['neighbor_clusters']).astype(str))
+        block = np.ix_(rows, cols)
+        self.pvals[s][block] = spot_result['pvals']
+        self.fractions[s][block] = spot_result['fractions']
+        self.permutations[s][block] = spot_result['permutations']
+
+    def significant_fractions(self, alpha=0.05):
+        """Fractions with the non significant (p-value above alpha) entries set to 0, NaN stays NaN.
+        """
+        return np.where(self.pvals <= alpha, self.fractions, np.where(np.isnan(self.fractions), np.nan, 0))
+
+    def observed(self):
+        """(n_spots, n_neighbor_clusters) mask of the neighbor clusters observed next to any cluster of a spot, the
+        rows of the original reports.
+        """
+        return (self.fractions > 0).any(axis=1)
+
+    def to_reports(self):
+        """The original reports: pval_report, fraction_report and permutation_report with neighbor clusters in rows,
+        target clusters in columns and the spot in the `group_id` column.
+        """
+        spot_idx, neighbor_idx = np.nonzero(self.observed())
+        reports = []
+        for values, fill in [(self.pvals, 1), (self.fractions, 0), (self.permutations, 0)]:
+            report = pd.DataFrame(values[spot_idx, :, neighbor_idx], columns=pd.Index(self.clusters),
+                                  index=pd.Index(self.neighbor_clusters[neighbor_idx], name='cluster'))
+            # target clusters absent from a spot
+            report = report.fillna(fill)
+            report['group_id'] = self.spots[spot_idx]
+            reports.append(report)
+        return tuple(reports)
+
+    def save(self, fn):
+        np.savez_compressed(fn, spots=self.spots, clusters=self.clusters,
+                            neighbor_clusters=self.neighbor_clusters, pvals=self.pvals,
+                            fractions=self.fractions, permutations=self.permutations)
+
+
+def load_neighborhood_cube(fn):
+    with np.load(fn) as data:
+        return NeighborhoodCube(data['spots'], data['clusters'], data['neighbor_clusters'], data['pvals'],
+                                data['fractions'], data['permutations'])
@@ -0,0 +1,279 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import matplotlib.pyplot as plt
+from cell_store import load_cells, CELLS_DIR, ANNOTATION_DIR
+from instrumentation import Instrumentation
+
+"""Rasterized rendering of ROIs for QC plots and plate or cohort overviews.
+
+Cell positions are binned into fixed resolution images, a pixel holding the mean of a marker or the most frequent
+cluster of its cells, with one vectorized pass over all ROIs of a plate. Tiles are cached per ROI in a tile store
+inside the cell store:
+    tiles/<value column>_<resolution>/<plate>.json
+        the rendering parameters and the size and modification times of the plate partitions and annotations the
+        tiles were made from. Tiles of a plate are rendered again when any of them changed.
+    tiles/<value column>_<resolution>/<plate>_<roi>.npz
+        `image`, `counts` (cells per pixel) and, for clusters, the `categories` the image codes refer to.
+Mosaics of the cached tiles then cover thousands of cores in a few seconds and a few hundred MB at most, e.g.
+
+    mosaic, labels, categories = cohort_mosaic(store, 'cluster')
+    plot_mosaic(mosaic, labels, categories)
+"""
+
+TILE_DIR = 'tiles'
+
+
+def rasterize_rois(x, y, roi_codes, n_rois, values=None, resolution=256, extent=None, categorical=False):
+    """Bin the cells of several ROIs into one image per ROI.
+
+    Parameters
+    ========
+    x, y : np.ndarray
+        cell positions.
+    roi_codes : np.ndarray
+        ROI of every cell, 0 to n_rois - 1.
+    values : np.ndarray or None
+        marker values (the pixel mean is used) or, with `categorical`, integer category codes (the most frequent code
+        of the pixel is used, -1 for empty pixels). None renders the cell density only.
+    resolution : int
+        image width and height in pixels.
+    extent : float or None
+        width and height of the area covered by an image in position units, starting at the smallest x and y of the
+        ROI. None fits each ROI to its own square, as `check_roi` plots a spot.
+
+    Returns
+    ========
+    images : np.ndarray
+        (n_rois, resolution, resolution) float32 means, NaN for empty pixels, or int16 category codes. Rows are y, so
+        plot with origin='lower'.
+    counts : np.ndarray
+        (n_rois, resolution, resolution) int32 number of cells per pixel.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    roi_codes = np.asarray(roi_codes, dtype=np.int64)
+    x0 = np.full(n_rois, np.inf)
+    y0 = np.full(n_rois, np.inf)
+    np.minimum.at(x0, roi_codes, x)
+    np.minimum.at(y0, roi_codes, y)
+    if extent is None:
+        span = np.zeros(n_rois)
+        np.maximum.at(span, roi_codes, np.maximum(x - x0[roi_codes], y - y0[roi_codes]))
+        span[span == 0] = 1
+    else:
+        span = np.full(n_rois, float(extent))
+    scale = resolution / span[roi_codes]
+    cols = np.clip(((x - x0[roi_codes]) * scale).astype(np.int64), 0, resolution - 1)
+    rows = np.clip(((y - y0[roi_codes]) * scale).astype(np.int64), 0, resolution - 1)
+    pixels = (roi_codes * resolution + rows) * resolution + cols
+    shape = (n_rois, resolution, resolution)
+    n_pixels = n_rois * resolution * resolution
+    counts = np.bincount(pixels, minlength=n_pixels).astype(np.int32)
+    if values is None:
+        return counts.reshape(shape).astype(np.float32), counts.reshape(shape)
+
+    values = np.asarray(values)
+    if categorical:
+        valid = values >= 0
+        pixels, values = pixels[valid], values[valid].astype(np.int64)
+        n_categories = values.max() + 1 if len(values) else 1
+        # counts of every occupied (pixel, category) pair, the last of a pixel after sorting by count is its mode
+        pairs, pair_counts = np.unique(pixels * n_categories + values, return_counts=True)
+        pair_pixels = pairs // n_categories
+        order = np.lexsort((pair_counts, pair_pixels))
+        pair_pixels = pair_pixels[order]
+        last = np.r_[pair_pixels[1:] != pair_pixels[:-1], True]
+        images = np.full(n_pixels, -1, dtype=np.int16)
+        images[pair_pixels[last]] = (pairs[order] % n_categories)[last]
+        return images.reshape(shape), counts.reshape(shape)
+
+    values = values.astype(np.float64)
+    valid = np.isfinite(values)
+    value_counts = np.bincount(pixels[valid], minlength=n_pixels)
+    sums = np.bincount(pixels[valid], weights=values[valid], minlength=n_pixels)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        images = (sums / value_counts).astype(np.float32)
+    return images.reshape(shape), counts.reshape(shape)
+
+
+def rasterize_roi(x, y, values=None, resolution=256, extent=None, categorical=False):
+    """Image and cell counts of a single ROI, see `rasterize_rois`.
+    """
+    images, counts = rasterize_rois(x, y, np.zeros(len(x), dtype=np.int64), 1, values, resolution, extent,
+                                    categorical)
+    return images[0], counts[0]
+
+
+def _store_column(value_col, channel_names=None):
+    """Store column of a channel name (Cell_Marker columns in channel order), other names are used as they are.
+    """
+    if (channel_names is not None) and (value_col in list(channel_names)):
+        return 'Cell_Marker{}'.format(list(channel_names).index(value_col) + 1)
+    return value_col
+
+
+def _source_key(store, plate, value_col, params):
+    """sha1 of the rendering parameters and the size and modification time of the plate partitions and of the
+    annotations a tile depends on.
+    """
+    stats = []
+    plate_dir = os.path.join(store, CELLS_DIR, 'Plate=' + plate)
+    for root, dirs, files in os.walk(plate_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            stat = os.stat(os.path.join(root, fn))
+            stats.append([os.path.relpath(os.path.join(root, fn), plate_dir), stat.st_size, stat.st_mtime_ns])
+    for col in ['ROI', 'X_position', 'Y_position', value_col]:
+        fn = os.path.join(store, ANNOTATION_DIR, col + '.parquet')
+        if os.path.exists(fn):
+            stat = os.stat(fn)
+            stats.append([col, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps([params, stats]).encode()).hexdigest()
+
+
+def plate_tiles(store, plate, value_col, resolution=256, extent=None, categorical=None, channel_names=None,
+                tile_dir=None, instrument=None):
+    """Tiles of all ROIs of a plate, read from the tile store or rendered in one pass and cached.
+
+    Parameters
+    ========
+    store : str
+        cell store folder.
+    plate : str
+        plate name.
+    value_col : str
+        store column (e.g. `cluster` or `Cell_Marker5`) or, with `channel_names`, a channel name.
+    categorical : bool or None
+        render the most frequent value of a pixel instead of the mean. None uses it for non numeric columns.
+    tile_dir : str or None
+        tile store folder, defaults to tiles/<value_col>_<resolution> in the cell store.
+
+    Returns
+    ========
+    tiles : dict
+        ROI to a dict with the `image`, the `counts` and the `categories` (None for markers), in ROI order.
+    """
+    value_col = _store_column(value_col, channel_names)
+    tile_dir = os.path.join(store, TILE_DIR, '{}_{}'.format(value_col, resolution)) if tile_dir is None else tile_dir
+    instrument = Instrumentation() if instrument is None else instrument
+    params = {'value_col': value_col, 'resolution': resolution, 'extent': extent, 'categorical': categorical}
+    key = _source_key(store, plate, value_col, params)
+    index_fn = os.path.join(tile_dir, plate + '.json')
+    with instrument.span('plate_tiles', plate=plate, value_col=value_col, resolution=resolution) as record:
+        if os.path.exists(index_fn):
+            with open(index_fn) as f:
+                index = json.load(f)
+            if index['key'] == key:
+                record.update(cached=True, n_rois=len(index['rois']))
+                tiles = {}
+                for roi in index['rois']:
+                    with np.load(os.path.join(tile_dir, '{}_{}.npz'.format(plate, roi)), allow_pickle=False) as data:
+                        tiles[roi] = {'image': data['image'], 'counts': data['counts'],
+                                      'categories': data['categories'] if 'categories' in data else None}
+                return tiles
+
+        cells = load_cells(store, ['ROI', 'X_position', 'Y_position', value_col], filters=[('Plate', '==', plate)])
+        if categorical is None:
+            categorical = not pd.api.types.is_numeric_dtype(cells[value_col])
+        roi_codes, rois = pd.factorize(cells.ROI.astype(int), sort=True)
+        values, categories = cells[value_col].values, None
+        if categorical:
+            values, categories = pd.factorize(cells[value_col], sort=True)
+            categories = np.asarray(categories).astype(str)
+        images, counts = rasterize_rois(cells.X_position.values, cells.Y_position.values, roi_codes, len(rois),
+                                        values, resolution, extent, categorical)
+        os.makedirs(tile_dir, exist_ok=True)
+        tiles = {}
+        for i, roi in enumerate(rois):
+            roi = int(roi)
+            tiles[roi] = {'image': images[i], 'counts': counts[i], 'categories': categories}
+            arrays = {'image': images[i], 'counts': counts[i]}
+            if categories is not None:
+                arrays['categories'] = categories
+            np.savez_compressed(os.path.join(tile_dir, '{}_{}.npz'.format(plate, roi)), **arrays)
+        # the index is written last, an interrupted rendering is redone
+        with open(index_fn + '.tmp', 'w') as f:
+            json.dump({'key': key, 'params': params, 'rois': [int(x) for x in rois]}, f)
+        os.replace(index_fn + '.tmp', index_fn)
+        record.update(cached=False, n_rois=len(rois), rows=len(cells))
+    return tiles
+
+
+def compose_mosaic(tiles, n_cols=None):
+    """Arrange tiles in a grid.
+
+    Parameters
+    ========
+    tiles : dict
+        label to tile, as returned by `plate_tiles`, in the order they are placed (row by row).
+    n_cols : int or None
+        tiles per mosaic row, defaults to a square grid.
+
+    Returns
+    ========
+    mosaic : np.ndarray
+        float32 image, NaN for empty pixels and the gaps. Category codes of categorical tiles refer to `categories`.
+    labels : pd.DataFrame
+        label, row and col (pixel offsets of the tile corner) of every tile.
+    categories : np.ndarray or None
+        sorted categories of all tiles.
+    """
+    labels = list(tiles)
+    if not labels:
+        return np.full((0, 0), np.nan, dtype=np.float32), pd.DataFrame(columns=['label', 'row', 'col']), None
+    resolution = tiles[labels[0]]['image'].shape[0]
+    n_cols = int(np.ceil(np.sqrt(len(labels)))) if n_cols is None else n_cols
+    n_rows = int(np.ceil(len(labels) / n_cols))
+    tile_categories = [x['categories'] for x in tiles.values() if x['categories'] is not None]
+    categories = np.unique(np.concatenate(tile_categories)) if tile_categories else None
+    mosaic = np.full((n_rows * resolution, n_cols * resolution), np.nan, dtype=np.float32)
+    positions = []
+    for i, label in enumerate(labels):
+        tile = tiles[label]
+        image = tile['image']
+        if tile['categories'] is not None:
+            codes = np.searchsorted(categories, tile['categories'])
+            image = np.where(image >= 0, codes[np.maximum(image, 0)], np.nan)
+        # tiles are stored with y in rows, the mosaic is drawn with origin='upper'
+        row, col = (i // n_cols) * resolution, (i % n_cols) * resolution
+        mosaic[row:row + resolution, col:col + resolution] = image[::-1]
+        positions.append([label, row, col])
+    return mosaic, pd.DataFrame(positions, columns=['label', 'row', 'col']), categories
+
+
+def cohort_mosaic(store, value_col, plates=None, resolution=128, n_cols=None, **kwargs):
+    """Mosaic of the ROIs of several plates (all plates of the store by default), labeled `<plate>_<roi>`.
+    kwargs are passed to `plate_tiles`.
+    """
+    if plates is None:
+        plates = sorted(x.split('=', 1)[1] for x in os.listdir(os.path.join(store, CELLS_DIR))
+                        if x.startswith('Plate='))
+    tiles = {}
+    for plate in plates:
+        for roi, tile in plate_tiles(store, plate, value_col, resolution=resolution, **kwargs).items():
+            tiles['{}_{}'.format(plate, roi)] = tile
+    return compose_mosaic(tiles, n_cols)
+
+
+def plot_mosaic(mosaic, labels=None, categories=None, ax=None, cmap=None, percentiles=(1, 99), label_size=6):
+    """Draw a mosaic, markers scaled to the given percentiles of all pixels, categories with one color each.
+    """
+    if ax is None:
+        _, ax = plt.subplots(figsize=(16, 16 * mosaic.shape[0] / max(mosaic.shape[1], 1)))
+    if categories is None:
+        vmin, vmax = np.nanpercentile(mosaic, percentiles) if np.isfinite(mosaic).any() else (0, 1)
+        im = ax.imshow(mosaic, cmap=cmap or 'coolwarm', vmin=vmin, vmax=vmax, interpolation='nearest')
+        plt.colorbar(im, ax=ax, fraction=0.03)
+    else:
+        cmap = plt.get_cmap(cmap or 'tab20', len(categories))
+        ax.imshow(mosaic, cmap=cmap, vmin=-0.5, vmax=len(categories) - 0.5, interpolation='nearest')
+        handles = [plt.Rectangle((0, 0), 1, 1, color=cmap(i)) for i in range(len(categories))]
+        ax.legend(handles, categories, loc='upper left', bbox_to_anchor=(1, 1), fontsize=8)
+    if labels is not None:
+        for label, row, col in labels[['label', 'row', 'col']].values:
+            ax.text(col, row, label, va='top', ha='left', fontsize=label_size)
+    ax.set_axis_off()
+    return ax
@@ -0,0 +1,377 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from instrumentation import Instrumentation
+
+"""Config driven runner of the pipeline, replacing the manual execution order of the scripts.
+
+The stages are expanded into tasks (ingestion runs as one task per plate) with declared inputs and outputs. A task
+depends on the tasks whose outputs it reads and runs as soon as these are done, independent tasks run concurrently in
+worker processes. Before a task runs, its inputs, the source files of its stage and its parameters are hashed. A task
+whose hash matches the previous successful run and whose outputs exist is skipped, so after a change only the affected
+tasks rerun. The hashes are kept in `pipeline_state.json` in the store folder, file hashes are cached by size and
+modification time.
+
+    python run_pipeline.py pipeline.yaml
+    python run_pipeline.py pipeline.yaml --dry-run
+    python run_pipeline.py pipeline.yaml --force gmm
+"""
+
+STATE_FN = 'pipeline_state.json'
+# source files of each stage, changes rerun the stage
+STAGE_CODE = {
+    'ingest': ['histocat_data_processing.py', 'cell_store.py'],
+    'qc': ['intensity_mask_size_qc.py', 'cell_store.py'],
+    'correct_roi': ['correct_ROI_ids.py', 'cell_store.py'],
+    'neighbor_index': ['neighbor_index.py', 'cell_store.py'],
+    'gmm': ['gmm_gating.py', 'cell_store.py'],
+    'neighborhood': ['neighborhood_analysis_of_clusters.py', 'neighborhood_cube.py', 'neighbor_index.py',
+                     'cell_store.py'],
+    'heatmap': ['make_neighborhood_analysis_heatmap.py', 'neighborhood_cube.py'],
+}
+
+
+def load_config(fn):
+    """Read the pipeline config (YAML or JSON). Relative paths are resolved against the folder of the config file.
+
+    Keys
+    ========
+    histocat_dir, store, results_dir : str
+        histoCAT output folder, cell store folder and results folder.
+    ashlar_mapping : str
+        ashlar ROI mapping sheet (xlsx or csv).
+    channel_info : str
+        channel table (csv or synapse id) with the channel names in Cell_Marker order.
+    patient_sheet, gating_tree : str, optional
+        patient excel file for the gating groups and gating tree file, see `gmm_gating.gate_store`. Without a gating
+        tree file (key or file missing), `GATING_TREE` is used.
+    roi_metadata, site_annotation : str, optional
+        ROI metadata csv and site annotation excel file, the Morpheus heatmap table is only made if both are given.
+    plates : list, optional
+        plates to process, by default all plates of the histocat_dir.
+    max_parallel : int, optional
+        number of tasks run at the same time, by default the number of plates.
+    n_jobs : int, optional
+        worker processes within the cohort level stages, default 1.
+    run_log : str, optional
+        JSONL run log, see `instrumentation`.
+    params : dict, optional
+        additional arguments of the stages by stage name, e.g. {'qc': {'area_threshold': 9}, 'neighborhood':
+        {'sequential': True}, 'gmm': {'rename_clusters': True}}. `rename_clusters` applies `CLUSTER_NAMES` of the
+        default gating tree, a custom tree can name its label combinations with a `cluster_names` mapping.
+    """
+    with open(fn) as f:
+        if fn.endswith('.json'):
+            config = json.load(f)
+        else:
+            import yaml
+            config = yaml.safe_load(f)
+    config_dir = os.path.dirname(os.path.abspath(fn))
+    for key in ['histocat_dir', 'store', 'results_dir', 'ashlar_mapping', 'channel_info', 'patient_sheet',
+                'gating_tree', 'roi_metadata', 'site_annotation', 'run_log']:
+        value = config.get(key)
+        if (value is not None) and not (key == 'channel_info' and re.fullmatch(r'syn\d+', value)):
+            config[key] = os.path.normpath(os.path.join(config_dir, value))
+    config.setdefault('params', {})
+    config.setdefault('n_jobs', 1)
+    if config.get('plates') is None:
+        from histocat_data_processing import list_roi_files
+        config['plates'] = sorted(set(x[0] for x in list_roi_files(config['histocat_dir'])))
+    config.setdefault('max_parallel', len(config['plates']))
+    return config
+
+
+def _stage_instrument(config, stage):
+    return Instrumentation(config.get('run_log'), pipeline_stage=stage)
+
+
+def run_ingest(config, plate):
+    from histocat_data_processing import ingest_histocat
+    cells_dir = os.path.join(config['store'], 'cells')
+    # ROIs removed from the histoCAT output must not survive in the store
+    shutil.rmtree(os.path.join(cells_dir, 'Plate={}'.format(plate)), ignore_errors=True)
+    ingest_histocat(config['histocat_dir'], cells_dir, plates=[plate], instrument=_stage_instrument(config, 'ingest'),
+                    **config['params'].get('ingest', {}))
+
+
+def run_qc(config):
+    from intensity_mask_size_qc import lost_cell_qc
+    lost_cell_qc(config['store'], config['plates'], n_jobs=len(config['plates']), figure_dir=config['results_dir'],
+                 instrument=_stage_instrument(config, 'qc'), **config['params'].get('qc', {}))
+
+
+def run_correct_roi(config):
+    from correct_ROI_ids import read_ashlar_mapping, correct_store_rois, export_corrected_tables
+    correct_store_rois(config['store'], read_ashlar_mapping(config['ashlar_mapping']),
+                       _stage_instrument(config, 'correct_roi'))
+    if config['params'].get('correct_roi', {}).get('export_tables', False):
+        export_corrected_tables(config['store'], os.path.dirname(config['store']))
+
+
+def run_neighbor_index(config):
+    from neighbor_index import build_store_index
+    build_store_index(config['store'], os.path.join(config['store'], 'neighbor_index.npz'))
+
+
+def run_gmm(config):
+    from gmm_gating import gate_store, read_channel_names, load_gating_tree, export_clustered_metadata, GATING_TREE, \
+        CLUSTER_NAMES
+    params = dict(config['params'].get('gmm', {}))
+    # as in gmm_gating, the gating tree file is optional
+    gating_tree = GATING_TREE
+    if (config.get('gating_tree') is not None) and os.path.exists(config['gating_tree']):
+        gating_tree = load_gating_tree(config['gating_tree'])
+    # CLUSTER_NAMES only names the combinations of GATING_TREE, other trees give their names in `cluster_names`
+    cluster_names = params.pop('cluster_names', None)
+    if params.pop('rename_clusters', False) and (cluster_names is None):
+        if gating_tree == GATING_TREE:
+            cluster_names = CLUSTER_NAMES
+        else:
+            print('rename_clusters skipped, CLUSTER_NAMES only applies to the default gating tree')
+    metadata = gate_store(config['store'], read_channel_names(config['channel_info']), gating_tree,
+                          patient_sheet=config.get('patient_sheet'), cluster_names=cluster_names,
+                          n_jobs=config['n_jobs'], instrument=_stage_instrument(config, 'gmm'), **params)
+    export_clustered_metadata(metadata, os.path.join(config['results_dir'], 'clustered_metadata.csv'))
+
+
+def run_neighborhood(config):
+    from neighborhood_analysis_of_clusters import analyze_store
+    params = dict(config['params'].get('neighborhood', {}))
+    params.setdefault('random_state', 0)
+    analyze_store(config['store'], os.path.join(config['store'], 'neighbor_index.npz'), config['results_dir'],
+                  n_jobs=config['n_jobs'], cache_dir=os.path.join(config['results_dir'], 'neighborhood_cache'),
+                  instrument=_stage_instrument(config, 'neighborhood'), **params)
+
+
+def run_heatmap(config):
+    import pandas as pd
+    from make_neighborhood_analysis_heatmap import morpheus_table
+    from neighborhood_cube import load_neighborhood_cube
+    roi_meta = pd.read_csv(config['roi_metadata'], index_col=0)
+    site_annotation = pd.read_excel(config['site_annotation'], index_col=0)
+    roi_meta = roi_meta.merge(site_annotation, left_on='Site', right_index=True)
+    cube = load_neighborhood_cube(os.path.join(config['results_dir'], 'neighborhood_cube.npz'))
+    morpheus_table(cube, roi_meta, **config['params'].get('heatmap', {})).transpose().to_csv(
+        os.path.join(config['results_dir'], 'neighborhood_analysis_heatmap.csv'))
+
+
+def pipeline_tasks(config):
+    """Tasks of the pipeline in execution order, as dicts with the task name, stage, inputs, outputs and the
+    arguments of its `run_<stage>` function.
+    """
+    from histocat_data_processing import list_roi_files
+    store = config['store']
+    cells = os.path.join(store, 'cells')
+    annotation = lambda name: os.path.join(store, 'annotations', name + '.parquet')
+    results = lambda name: os.path.join(config['results_dir'], name)
+    roi_files = list_roi_files(config['histocat_dir'])
+    tasks = []
+    for plate in config['plates']:
+        tasks.append({'name': 'ingest[{}]'.format(plate), 'stage': 'ingest', 'args': (plate,),
+                      'inputs': [fn for _plate, _, fn in roi_files if _plate == plate],
+                      'outputs': [os.path.join(cells, 'Plate={}'.format(plate))]})
+    tasks += [
+        {'name': 'qc', 'stage': 'qc', 'inputs': [cells], 'outputs': [annotation('labeled_as_lost')]
+         + [results(plate + '_nuclei_log_normed.png') for plate in config['plates']]},
+        {'name': 'correct_roi', 'stage': 'correct_roi', 'inputs': [cells, config['ashlar_mapping']],
+         'outputs': [annotation('ROI')]},
+        {'name': 'neighbor_index', 'stage': 'neighbor_index',
+         'inputs': [cells, annotation('ROI'), annotation('labeled_as_lost')],
+         'outputs': [os.path.join(store, 'neighbor_index.npz')]},
+        {'name': 'gmm', 'stage': 'gmm',
+         'inputs': [cells, annotation('ROI'), annotation('labeled_as_lost')] + [
+             config[x] for x in ['channel_info', 'patient_sheet', 'gating_tree']
+             if (config.get(x) is not None) and os.path.exists(config[x])],
+         'outputs': [annotation('cluster'), results('clustered_metadata.csv')]},
+        {'name': 'neighborhood', 'stage': 'neighborhood',
+         'inputs': [annotation('ROI'), annotation('labeled_as_lost'), annotation('cluster'),
+                    os.path.join(store, 'neighbor_index.npz')],
+         'outputs': [results('neighborhood_cube.npz')]},
+    ]
+    if (config.get('roi_metadata') is not None) and (config.get('site_annotation') is not None):
+        tasks.append({'name': 'heatmap', 'stage': 'heatmap',
+                      'inputs': [results('neighborhood_cube.npz'), config['roi_metadata'], config['site_annotation']],
+                      'outputs': [results('neighborhood_analysis_heatmap.csv')]})
+    for task in tasks:
+        task.setdefault('args', ())
+        task['params'] = config['params'].get(task['stage'], {})
+        task['code'] = [os.path.join(os.path.dirname(os.path.abspath(__file__)), x) for x in STAGE_CODE[task['stage']]]
+    return tasks
+
+
+def _contains(parent, path):
+    parent, path = os.path.abspath(parent), os.path.abspath(path)
+    return (path == parent) or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+
+def task_dependencies(tasks):
+    """Names of the tasks each task depends on: the tasks with an output that is, contains or is inside an input.
+    """
+    dependencies = {}
+    for task in tasks:
+        dependencies[task['name']] = [
+            other['name'] for other in tasks if (other is not task) and any(
+                _contains(x, y) or _contains(y, x) for x in task['inputs'] for y in other['outputs'])]
+    return dependencies
+
+
+class FileHasher:
+    """sha1 of files and folders, reusing the hashes of files whose size and modification time did not change.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = {} if cache is None else cache
+
+    def file_hash(self, fn):
+        stat = os.stat(fn)
+        cached = self.cache.get(fn)
+        if (cached is not None) and (cached[0] == stat.st_size) and (cached[1] == stat.st_mtime_ns):
+            return cached[2]
+        sha = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(2**22), b''):
+                sha.update(block)
+        self.cache[fn] = [stat.st_size, stat.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def path_hash(self, path):
+        """Hash of a file, or of all files in a folder with their relative paths. Missing paths hash as 'missing'.
+        """
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return 'missing'
+        sha = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(files):
+                if fn.endswith('.tmp'):
+                    continue
+                full_fn = os.path.join(root, fn)
+                sha.update(os.path.relpath(full_fn, path).replace(os.sep, '/').encode())
+                sha.update(self.file_hash(full_fn).encode())
+        return sha.hexdigest()
+
+    def task_hash(self, task):
+        sha = hashlib.sha1()
+        for path in sorted(task['inputs']) + task['code']:
+            sha.update(self.path_hash(path).encode())
+        sha.update(json.dumps([task['args'], task['params']], sort_keys=True, default=str).encode())
+        return sha.hexdigest()
+
+
+def _run_task(config, task):
+    globals()['run_' + task['stage']](config, *task['args'])
+
+
+def run_pipeline(config, only=None, force=(), dry_run=False):
+    """Run the pipeline tasks in dependency order, skipping up to date tasks.
+
+    Parameters
+    ========
+    config : dict
+        see `load_config`.
+    only : list or None
+        stage or task names to consider, e.g. ['gmm', 'neighborhood']. Their dependencies are not run.
+    force : list
+        stage or task names that are rerun even if up to date.
+    dry_run : bool
+        only report which tasks would run.
+
+    Returns
+    ========
+    status : dict
+        'skipped', 'done', 'failed', 'blocked' (a dependency failed) or 'would run' of each task.
+    """
+    os.makedirs(config['store'], exist_ok=True)
+    os.makedirs(config['results_dir'], exist_ok=True)
+    state_fn = os.path.join(config['store'], STATE_FN)
+    state = {'tasks': {}, 'files': {}}
+    if os.path.exists(state_fn):
+        with open(state_fn) as f:
+            state = json.load(f)
+    hasher = FileHasher(state['files'])
+    instrument = Instrumentation(config.get('run_log'))
+    tasks = pipeline_tasks(config)
+    selected = lambda task, names: (task['name'] in names) or (task['stage'] in names)
+    if only is not None:
+        tasks = [x for x in tasks if selected(x, only)]
+    dependencies = task_dependencies(tasks)
+    for task in tasks:
+        missing = [x for x in task['inputs'] if not os.path.exists(x) and not dependencies[task['name']]]
+        if missing:
+            raise FileNotFoundError('Missing inputs of {}: {}'.format(task['name'], missing))
+
+    def save_state():
+        with open(state_fn + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_fn + '.tmp', state_fn)
+
+    status = {}
+    pending = list(tasks)
+    running = {}
+    with ProcessPoolExecutor(config['max_parallel']) as executor:
+        while pending or running:
+            for task in list(pending):
+                dependency_status = [status.get(x) for x in dependencies[task['name']]]
+                if any(x in ['failed', 'blocked'] for x in dependency_status):
+                    status[task['name']] = 'blocked'
+                elif all(x in ['skipped', 'done', 'would run'] for x in dependency_status):
+                    task_hash = hasher.task_hash(task)
+                    up_to_date = (state['tasks'].get(task['name']) == task_hash) and all(
+                        os.path.exists(x) for x in task['outputs'])
+                    if 'would run' in dependency_status:
+                        up_to_date = False
+                    if up_to_date and not selected(task, force):
+                        status[task['name']] = 'skipped'
+                    elif dry_run:
+                        status[task['name']] = 'would run'
+                    else:
+                        running[executor.submit(_run_task, config, task)] = (task, task_hash, time.perf_counter())
+                        status[task['name']] = 'running'
+                else:
+                    continue
+                pending.remove(task)
+                if status[task['name']] != 'running':
+                    print('{:<24}{}'.format(task['name'], status[task['name']]))
+                    instrument.log('task', task=task['name'], status=status[task['name']])
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, task_hash, start = running.pop(future)
+                seconds = time.perf_counter() - start
+                try:
+                    future.result()
+                except Exception:
+                    status[task['name']] = 'failed'
+                    traceback.print_exc()
+                    state['tasks'].pop(task['name'], None)
+                else:
+                    status[task['name']] = 'done'
+                    state['tasks'][task['name']] = task_hash
+                print('{:<24}{} ({:.1f}s)'.format(task['name'], status[task['name']], seconds))
+                instrument.log('task', task=task['name'], status=status[task['name']], seconds=round(seconds, 3))
+                save_state()
+    # forget the hashes of deleted files
+    state['files'] = {k: v for k, v in state['files'].items() if os.path.exists(k)}
+    save_state()
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the TMA pipeline stages that are out of date.')
+    parser.add_argument('config', help='pipeline config, YAML or JSON')
+    parser.add_argument('--only', nargs='+', default=None, help='stages or tasks to consider, e.g. gmm')
+    parser.add_argument('--force', nargs='+', default=[], help='stages or tasks to rerun even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='only show which tasks would run')
+    args = parser.parse_args()
+    status = run_pipeline(load_config(args.config), args.only, args.force, args.dry_run)
+    sys.exit(int(any(x in ['failed', 'blocked'] for x in status.values())))
@@ -0,0 +1,81 @@
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+from neighbor_index import index_from_adjacencies
+from cell_store import load_cells
+
+
+def spot_spatial_adjacency(positions, radius=None, k=None, batch_size=10000):
+    """CSR adjacency of one spot from cell positions.
+
+    Parameters
+    ========
+    positions : np.ndarray
+        (n_cells, 2) X/Y positions.
+    radius : float or None
+        cells within `radius` of a cell are its neighbors.
+    k : int or None
+        the k nearest cells are the neighbors. If both are given, the k nearest cells within radius.
+    batch_size : int
+        number of cells queried at once.
+
+    Returns
+    ========
+    indptr, indices : np.ndarray
+        CSR row pointers and int32 neighbor positions within the spot, excluding the cell itself.
+    """
+    if (radius is None) & (k is None):
+        raise ValueError('Either radius or k is required')
+    n_cells = len(positions)
+    tree = cKDTree(positions)
+    rows_list = []
+    cols_list = []
+    for start in range(0, n_cells, batch_size):
+        batch = positions[start:start + batch_size]
+        if k is None:
+            pairs = cKDTree(batch).sparse_distance_matrix(tree, radius, output_type='ndarray')
+            rows, cols = pairs['i'] + start, pairs['j']
+            valid = cols != rows
+        else:
+            _k = min(k + 1, n_cells)
+            _, cols = tree.query(batch, k=_k, distance_upper_bound=np.inf if radius is None else radius)
+            cols = cols.reshape(len(batch), _k)
+            rows = np.repeat(np.arange(start, start + len(batch)), _k).reshape(len(batch), _k)
+            valid = (cols < n_cells) & (cols != rows)
+            # the k nearest apart from the cell itself
+            valid &= np.cumsum(valid, axis=1) <= k
+            rows, cols, valid = rows.ravel(), cols.ravel(), valid.ravel()
+        rows_list.append(rows[valid])
+        cols_list.append(cols[valid])
+    rows = np.concatenate(rows_list)
+    cols = np.concatenate(cols_list)
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_cells), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32)
+
+
+def build_spatial_neighbor_index(metadata, radius=None, k=None, grouping_col='group_id', batch_size=10000):
+    """`NeighborIndex` from the X_position/Y_position columns with a KD-tree per spot, as an alternative to the
+    histoCAT `neighbour` columns. The result can be used wherever `build_neighbor_index` is, e.g. in
+    `neighborhood_analysis` and `neighbor_across_spots`.
+    """
+    positions = metadata[['X_position', 'Y_position']].values.astype(float)
+    spot_rows = metadata.groupby(grouping_col).indices
+    spots = sorted(spot_rows.keys())
+    adjacencies = (spot_spatial_adjacency(positions[spot_rows[spot]], radius=radius, k=k, batch_size=batch_size)
+                   for spot in spots)
+    return index_from_adjacencies(spots, adjacencies)
+
+
+if __name__ == '__main__':
+    """Neighbor indices for a range of radii, next to the cell store.
+    """
+    path = 'N:/HiTS Projects and Data/Personal/Jake/mgh_tma/processed_data'
+    os.chdir(path)
+    # cells that passed the QC, as in `build_store_index`, so `analyze_store` accepts the index
+    metadata = load_cells('cell_store', ['ROI', 'X_position', 'Y_position'], filters=[('labeled_as_lost', '==', False)])
+    metadata['group_id'] = metadata.Plate.astype(str) + '_' + metadata.ROI.astype(str)
+    for radius in [10, 20, 30, 50]:
+        build_spatial_neighbor_index(metadata, radius=radius).save(
+            'neighbor_index_r{}.npz'.format(radius))
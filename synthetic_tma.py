@@ -0,0 +1,145 @@
+import pandas as pd
+import numpy as np
+import os
+import argparse
+from scipy.spatial import cKDTree
+
+"""Synthetic histoCAT outputs with the layout of the TMA data, for benchmarking the pipeline without real data.
+"""
+
+# channel names in Cell_Marker order, one DNA channel per cycle at every 4th marker starting with Cell_Marker5
+CHANNEL_NAMES = [
+    'bg1', 'bg2', 'bg3', 'bg4',
+    'DNA1', 'Ecad', 'CK8-FITC', 'aSMA',
+    'DNA2', 'gH2ax-PE', 'CD45-PE', 'CD4',
+    'DNA3', 'CD8a', 'Ki67-570', 'Vim',
+    'DNA4', 'CD3', 'CD20', 'CD68',
+    'DNA5', 'PD1', 'PDL1', 'FOXP3',
+    'DNA6', 'ER', 'PR', 'HER2',
+    'DNA7', 'CK5', 'CK14', 'CK19',
+    'DNA8', 'pRB', 'CDK4', 'CycD1',
+    'DNA9', 'p21', 'p53', 'Lamin',
+    'DNA10', 'CD31', 'Col1', 'PCNA',
+]
+
+# cell types with the markers they express
+CELL_TYPES = {
+    'Epi': ['Ecad', 'CK8-FITC', 'CK19', 'ER'],
+    'Stromal': ['aSMA', 'Vim', 'Col1'],
+    'CD4_T': ['CD45-PE', 'CD4', 'CD3'],
+    'CD8_T': ['CD45-PE', 'CD8a', 'CD3'],
+    'Myeloid': ['CD45-PE', 'CD68'],
+}
+
+
+def synthetic_roi(n_cells, roi_radius=None, n_neighbours=10, lost_fraction=0.05, random_state=0):
+    """One ROI table in the histoCAT layout: ImageId, CellId, Cell_Marker1-44 (log2 scale), Area, X/Y positions,
+    Number_Neighbors and neighbour_1..n columns with the CellIds of touching cells (0 if none).
+
+    Cells of the same type are spatially clustered, dividing cells express Ki67 and a `lost_fraction` of the cells
+    loses its DNA signal after a random cycle.
+    """
+    rng = np.random.RandomState(random_state)
+    if roi_radius is None:
+        roi_radius = np.sqrt(n_cells) * 6
+    # cell positions in a disk, cell types spatially clustered around a few centers
+    angle = rng.rand(n_cells) * 2 * np.pi
+    radius = roi_radius * np.sqrt(rng.rand(n_cells))
+    positions = np.column_stack([radius * np.cos(angle), radius * np.sin(angle)]) + roi_radius
+    type_names = list(CELL_TYPES)
+    centers = rng.rand(len(type_names) * 3, 2) * 2 * roi_radius
+    center_type = np.tile(np.arange(len(type_names)), 3)
+    _, nearest_center = cKDTree(centers).query(positions, k=1)
+    cell_type = np.where(rng.rand(n_cells) < 0.7, center_type[nearest_center],
+                         rng.randint(len(type_names), size=n_cells))
+
+    expr = rng.normal(6, 0.6, (n_cells, len(CHANNEL_NAMES)))
+    for i, name in enumerate(type_names):
+        cols = [CHANNEL_NAMES.index(x) for x in CELL_TYPES[name]]
+        rows = np.flatnonzero(cell_type == i)
+        expr[np.ix_(rows, cols)] += rng.normal(3, 0.5, (len(rows), len(cols)))
+    expr[:, CHANNEL_NAMES.index('Ki67-570')] += 3 * (rng.rand(n_cells) < 0.2)
+    expr[:, CHANNEL_NAMES.index('gH2ax-PE')] += 2 * (rng.rand(n_cells) < 0.3)
+    # DNA, slowly decaying over the cycles, with lost cells dropping to background
+    dna_cols = [i for i, x in enumerate(CHANNEL_NAMES) if x.startswith('DNA')]
+    base_dna = rng.normal(12, 0.4, n_cells)
+    expr[:, dna_cols] = base_dna[:, None] - 0.05 * np.arange(len(dna_cols)) + rng.normal(
+        0, 0.1, (n_cells, len(dna_cols)))
+    lost = np.flatnonzero(rng.rand(n_cells) < lost_fraction)
+    lost_cycle = rng.randint(1, len(dna_cols), size=len(lost))
+    for cycle in range(1, len(dna_cols)):
+        expr[lost[lost_cycle <= cycle], dna_cols[cycle]] -= 5
+
+    cell_ids = np.arange(1, n_cells + 1)
+    # neighbours are the cells within the typical touching distance
+    distances, neighbours = cKDTree(positions).query(positions, k=min(n_neighbours + 1, n_cells))
+    neighbours = neighbours.reshape(n_cells, -1)[:, 1:]
+    distances = distances.reshape(n_cells, -1)[:, 1:]
+    neighbour_ids = np.where(distances < 12, cell_ids[neighbours], 0)
+
+    roi = pd.DataFrame(expr, columns=['Cell_Marker{}'.format(i + 1) for i in range(len(CHANNEL_NAMES))])
+    roi.insert(0, 'CellId', cell_ids)
+    roi.insert(0, 'ImageId', 1)
+    roi['Area'] = rng.gamma(9, 4, n_cells).round().astype(int)
+    roi['X_position'] = positions[:, 0]
+    roi['Y_position'] = positions[:, 1]
+    roi['Number_Neighbors'] = (neighbour_ids > 0).sum(axis=1)
+    for k in range(neighbour_ids.shape[1]):
+        roi['neighbour_{}'.format(k + 1)] = neighbour_ids[:, k]
+    return roi
+
+
+def write_synthetic_tma(out_dir, n_cells=10000, n_plates=4, rois_per_plate=None, random_state=0):
+    """Write a synthetic histoCAT output folder and the matching ashlar ROI mapping.
+
+    Parameters
+    ========
+    out_dir : str
+        folder that gets a `histocat_output` folder with one `<date>_xx<plate>_<roi>_nucleiMask/<roi>.csv` per ROI,
+        `tma_ROI ashlar mapping.csv` and `channel_info.csv` with the channel names (cycles in rows).
+    n_cells : int
+        total number of cells, spread evenly over the ROIs.
+    n_plates : int
+        number of plates, named TMA1, TMA2, ...
+    rois_per_plate : int or None
+        number of ROIs per plate, by default about 2500 cells per ROI, at most 100 ROIs per plate.
+
+    Returns
+    ========
+    ashlar_meta : pd.DataFrame
+        ROI mapping in the layout of the ashlar mapping sheet: histoCAT ROI per plate and the `Ashlar_ROI`.
+    """
+    if rois_per_plate is None:
+        rois_per_plate = int(np.clip(n_cells // (n_plates * 2500), 1, 100))
+    cells_per_roi = max(n_cells // (n_plates * rois_per_plate), 1)
+    histocat_dir = os.path.join(out_dir, 'histocat_output')
+    os.makedirs(histocat_dir, exist_ok=True)
+    rng = np.random.RandomState(random_state)
+    ashlar_meta = pd.DataFrame({'Ashlar_ROI': np.arange(1, rois_per_plate + 1)},
+                               index=pd.Index(np.arange(rois_per_plate), name='core'))
+    for plate in range(1, n_plates + 1):
+        plate_name = 'TMA{}'.format(plate)
+        # histoCAT numbers the cores in a different order than ashlar
+        ashlar_meta[plate_name] = rng.permutation(rois_per_plate) + 1
+        for roi in range(1, rois_per_plate + 1):
+            roi_dir = os.path.join(histocat_dir, '20190101_xx{}_{}_nucleiMask'.format(plate_name, roi))
+            os.makedirs(roi_dir, exist_ok=True)
+            synthetic_roi(cells_per_roi, random_state=rng.randint(2**31)).to_csv(
+                os.path.join(roi_dir, '{}.csv'.format(roi)), index=False)
+    ashlar_meta.to_csv(os.path.join(out_dir, 'tma_ROI ashlar mapping.csv'))
+    channel_info = pd.DataFrame(np.reshape(CHANNEL_NAMES, (-1, 4)),
+                                index=pd.Index(np.arange(1, len(CHANNEL_NAMES) // 4 + 1), name='cycle'),
+                                columns=['channel_{}'.format(i) for i in range(1, 5)])
+    channel_info.to_csv(os.path.join(out_dir, 'channel_info.csv'))
+    return ashlar_meta
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic histoCAT outputs.')
+    parser.add_argument('out_dir')
+    parser.add_argument('--cells', type=int, default=10000)
+    parser.add_argument('--plates', type=int, default=4)
+    parser.add_argument('--rois-per-plate', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_synthetic_tma(args.out_dir, args.cells, args.plates, args.rois_per_plate, args.seed)
@@ -1,12 +1,73 @@
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 import os
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import pdist, cdist
+from cell_store import load_roi, list_columns
+from roi_raster import rasterize_roi
 
 
-def spotwise_clusterdist_plot(plot_data, metric='Euclidean'):
+def site_distance_histograms(features, sites, metric='euclidean', bins=200, value_range=None, block_size=2048,
+                             max_cells=None, random_state=0):
+    """Histograms of the pairwise distances between cells from the same site and from different sites.
+
+    The condensed distances are computed in (block_size, block_size) tiles and binned right away, so memory stays
+    constant however many cells there are. Zero distances are excluded, as are identical pairs.
+
+    Parameters
+    ========
+    features : np.ndarray
+        (n_cells, n_features) data.
+    sites : array-like
+        site of each cell.
+    metric : str
+        any metric accepted by scipy's cdist.
+    bins : int
+        number of fixed width bins.
+    value_range : tuple or None
+        (min, max) of the bins. If None, it is 0 up to the largest possible distance for the euclidean metric, and
+        up to 1.5 times the largest distance within a sample of 2000 cells otherwise. Larger distances go into the
+        last bin.
+    max_cells : int or None
+        if given, a random subsample of at most max_cells cells is used.
+
+    Returns
+    ========
+    bin_edges, within_counts, across_counts : np.ndarray
+    """
+    features = np.asarray(features, dtype=float)
+    site_codes = pd.factorize(np.asarray(sites))[0]
+    rng = np.random.RandomState(random_state)
+    if (max_cells is not None) and (len(features) > max_cells):
+        keep = np.sort(rng.choice(len(features), max_cells, replace=False))
+        features, site_codes = features[keep], site_codes[keep]
+    if value_range is None:
+        if metric == 'euclidean':
+            value_range = (0, np.linalg.norm(features.max(axis=0) - features.min(axis=0)))
+        else:
+            sample = features[rng.choice(len(features), min(len(features), 2000), replace=False)]
+            value_range = (0, 1.5 * np.nanmax(pdist(sample, metric=metric)))
+    bin_edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    bin_width = bin_edges[1] - bin_edges[0]
+    within_counts = np.zeros(bins, dtype=np.int64)
+    across_counts = np.zeros(bins, dtype=np.int64)
+    n_cells = len(features)
+    for i in range(0, n_cells, block_size):
+        rows = np.arange(i, min(i + block_size, n_cells))
+        for j in range(i, n_cells, block_size):
+            cols = np.arange(j, min(j + block_size, n_cells))
+            dist = cdist(features[rows], features[cols], metric=metric)
+            valid = (cols[None, :] > rows[:, None]) & (dist > 0)
+            same_site = site_codes[rows][:, None] == site_codes[cols][None, :]
+            bin_idx = np.clip(((dist - bin_edges[0]) / bin_width).astype(np.int64), 0, bins - 1)
+            within_counts += np.bincount(bin_idx[valid & same_site], minlength=bins)
+            across_counts += np.bincount(bin_idx[valid & ~same_site], minlength=bins)
+    return bin_edges, within_counts, across_counts
+
+
+def spotwise_clusterdist_plot(plot_data, metric='Euclidean', bins=200, block_size=2048, max_cells=None):
+    """Within and across site distance distributions of each cluster, see `site_distance_histograms`.
+    """
     fig, axes = plt.subplots(1 + plot_data.cluster.nunique() //
                              3, 3, figsize=(16, 16), sharex=True, sharey=True)
     axes = axes.ravel()
@@ -16,42 +77,51 @@ def spotwise_clusterdist_plot(plot_data, metric='Euclidean'):
         group_df = group_df.sort_values(['cluster', 'Site'])
 
         dist_data = group_df.set_index('Site').iloc[:, 4:]
-        dist = squareform(pdist(dist_data, metric=metric))
-        site_names = dist_data.index
-        dist = pd.DataFrame(dist, index=site_names,
-                            columns=site_names).stack()
-        dist.index.names = ['Site1', 'Site2']
-        dist = dist.reset_index()
-        dist = dist[dist.iloc[:, 2] > 0]
-
-        same_spot_dist = dist[dist.Site1 == dist.Site2].iloc[:, 2]
-        diff_spot_dist = dist[dist.Site1 != dist.Site2].iloc[:, 2]
-        same_spot_dist.name = 'Within_spot_dist'
-        diff_spot_dist.name = 'Across_spot_dist'
-        sns.kdeplot(same_spot_dist, ax=axes[i])
-        sns.kdeplot(diff_spot_dist, ax=axes[i])
+        bin_edges, same_spot_dist, diff_spot_dist = site_distance_histograms(
+            dist_data.values, dist_data.index, metric=metric.lower(), bins=bins, block_size=block_size,
+            max_cells=max_cells)
+        bin_centers = (bin_edges[1:] + bin_edges[:-1]) / 2
+        bin_width = bin_edges[1] - bin_edges[0]
+        for counts, label in [(same_spot_dist, 'Within_spot_dist'), (diff_spot_dist, 'Across_spot_dist')]:
+            if counts.sum() > 0:
+                axes[i].plot(bin_centers, counts / (counts.sum() * bin_width), label=label)
+        axes[i].legend()
         axes[i].set_title(group_name)
         axes[i].set_xlabel(metric + ' distance', fontsize=16)
         i += 1
 
 
-def check_roi(expr_data, metadata, tma_roi, plotting=False):
+def load_store_roi(store, tma_roi, channel_names=None):
+    """Load the expression data and metadata (positions and group_id) of a single spot from the cell store.
+    """
+    marker_cols = [x for x in list_columns(store) if x.startswith('Cell_Marker')]
+    cells = load_roi(store, tma_roi, marker_cols + ['X_position', 'Y_position'])
+    expr_data = cells[marker_cols]
+    if channel_names is not None:
+        expr_data.columns = list(channel_names)
+    metadata = cells.drop(marker_cols, axis=1)
+    metadata['group_id'] = tma_roi
+    return expr_data, metadata
+
+
+def check_roi(expr_data, metadata, tma_roi, plotting=False, color_col='Ecad', channel_names=None, resolution=256):
+    """Expression data of a single spot, optionally plotted by position colored by `color_col`.
+    If `expr_data` is the path of a cell store (and metadata None), only the rows of the spot and the marker
+    columns, with `channel_names` as the names of the Cell_Marker columns, are loaded from the store.
+    The spot is drawn as a `resolution` x `resolution` image of the mean `color_col` per pixel, see `roi_raster`.
+    """
+    if isinstance(expr_data, str):
+        expr_data, metadata = load_store_roi(expr_data, tma_roi, channel_names)
     plot_data_idx = metadata[metadata.group_id == tma_roi].index
     if plotting:
-        color_col = 'Ecad'
         plot_data = metadata.loc[plot_data_idx]
         expr_data.loc[plot_data_idx, color_col].hist(bins=100)
-        x_vector = plot_data.X_position.astype(float).values
-        y_vector = plot_data.Y_position.astype(float).values
-        x_vector = x_vector - x_vector.min()
-        y_vector = y_vector - y_vector.min()
-        plot_data[color_col] = expr_data.loc[plot_data_idx, color_col]
+        image, _ = rasterize_roi(plot_data.X_position.astype(float).values, plot_data.Y_position.astype(float).values,
+                                 expr_data.loc[plot_data_idx, color_col].values, resolution=resolution)
         plt.figure(figsize=(9, 9))
-        sns.scatterplot(x_vector, y_vector, data=plot_data, hue=color_col,
-                        s=2, palette='coolwarm', edgecolor=None, alpha=0.6)
-        axis_max = np.max((x_vector.max(), y_vector.max()))
-        _ = plt.xlim((0, axis_max))
-        _ = plt.ylim((0, axis_max))
+        vmin, vmax = np.nanpercentile(image, (1, 99)) if np.isfinite(image).any() else (0, 1)
+        plt.imshow(image, origin='lower', cmap='coolwarm', vmin=vmin, vmax=vmax, interpolation='nearest')
+        plt.colorbar(fraction=0.03, label=color_col)
         return expr_data.loc[plot_data_idx]
     else:
         return expr_data.loc[plot_data_idx]